@@ -0,0 +1,49 @@
+# %%
+import argparse
+import time
+from pathlib import Path
+from bike_stem_mount.config import ConfigError, add_arguments, from_args
+
+# ================== COMMAND LINE ==================
+# Quickest way to export (or show) the assembly: the arguments and parameters are checked without importing build123d,
+# and the assembly is loaded from the snapshot (see snapshot.py) when it is up to date, which skips importing the part
+# scripts and building the parts. Otherwise, it is built as by main.py.
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(prog="python -m bike_stem_mount",
+                                     description="Exports the assembly as a STL or 3MF mesh, from the snapshot if it "
+                                                 "is up to date")
+    parser.add_argument("output", type=Path, nargs="?", default=Path("bike-stem-mount.stl"))
+    parser.add_argument("--quality", choices=["draft", "print", "fine"], default="print")  # export.QUALITY_PRESETS
+    parser.add_argument("--per-solid", action="store_true", help="Write one file per printable solid")
+    parser.add_argument("--show", action="store_true", help="Show the assembly in ocp_vscode instead of exporting it")
+    parser.add_argument("--write-snapshot", action="store_true",
+                        help="Also write the built assembly as the snapshot, if it was stale")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.output.suffix.lower() not in (".stl", ".3mf"):
+        parser.exit(2, "Unsupported mesh format %r (expected .stl or .3mf)\n" % args.output.suffix)
+    try:
+        config = from_args(args)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+
+    from bike_stem_mount.snapshot import load_snapshot, write_snapshot
+    assembly = load_snapshot(config)
+    source = "snapshot"
+    if assembly is None:
+        source = "build"
+        if args.write_snapshot:
+            assembly = write_snapshot(config)
+        else:
+            from bike_stem_mount.main import build_assembly
+            assembly = build_assembly(**config.params())
+    if args.show:
+        import ocp_vscode
+        ocp_vscode.show(assembly, names=["bike-stem-mount"])
+    else:
+        from bike_stem_mount.export import export_mesh
+        for file in export_mesh(assembly, args.output, args.quality, args.per_solid):
+            print("Exported %s" % file)
+    print("Done in %.1fs (assembly from the %s)" % (time.perf_counter() - start, source))
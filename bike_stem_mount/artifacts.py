@@ -0,0 +1,208 @@
+# %%
+import argparse
+import dataclasses
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional
+from build123d import Compound, Shape, export_step
+from bike_stem_mount.cache import from_brep, to_brep
+from bike_stem_mount.config import Config, _global_names
+from bike_stem_mount.parts import global_params
+from bike_stem_mount.export import QUALITY_PRESETS, Mesh, merge, piece_sizes, tessellate_all, write_3mf, write_amf, \
+    write_glb, write_stl
+
+# ================== ARTIFACTS ==================
+# Exports the assembly and each part in any set of formats into one directory, described by a manifest.json (part key,
+# SHA-256, size and export time of each file, and the parameters). Each target is built (or loaded from the part cache)
+# once, the solids shared by several targets are tessellated once for all the mesh formats, and the files are written in
+# parallel. Files whose inputs (part key, format, quality and exporter) match the previous manifest are kept as they
+# are, and the manifest marks which files changed, so that consumers (e.g. a print queue) only pick up those.
+
+MESH_FORMATS = {"stl": lambda path, meshes, names: write_stl(path, merge(meshes)),
+                "3mf": write_3mf,
+                "amf": write_amf,
+                "glb": write_glb}
+"""Written from the meshes of the printable pieces"""
+SHAPE_FORMATS = ("step", "brep", "svg")
+"""Written from the BREP of the target"""
+FORMATS = (*MESH_FORMATS, *SHAPE_FORMATS)
+MANIFEST = "manifest.json"
+
+_EXPORTER_HASH = hashlib.sha256(Path(__file__).read_bytes() +
+                                Path(__file__).with_name("export.py").read_bytes()).hexdigest()[:8]
+
+
+def targets(headset_p=None, stem_p=None, handle_bars_p=None) -> dict[str, tuple[str, Callable[[], Shape]]]:
+    """Cache key and builder of the assembly and of each part (with the default parameters if not given)"""
+    from bike_stem_mount.main import assembly_key, build_assembly
+    from bike_stem_mount.parts.headset_screw import build_headset_screw, headset_screw_key, p as default_headset_p
+    from bike_stem_mount.parts.stem import build_stem, stem_key, p as default_stem_p
+    from bike_stem_mount.parts.handle_bars import build_handle_bars, handle_bars_key, p as default_handle_bars_p
+    headset_p, stem_p = headset_p or default_headset_p, stem_p or default_stem_p
+    handle_bars_p = handle_bars_p or default_handle_bars_p
+    return {  # The assembly first, so that its parts are built in parallel
+        "assembly": (assembly_key(headset_p, stem_p, handle_bars_p),
+                     lambda: build_assembly(headset_p, stem_p, handle_bars_p)),
+        "headset_screw": (headset_screw_key(headset_p), lambda: build_headset_screw(headset_p)),
+        "stem": (stem_key(stem_p, headset_p), lambda: build_stem(stem_p, headset_p)[0]),
+        "handle_bars": (handle_bars_key(handle_bars_p, stem_p, headset_p),
+                        lambda: build_handle_bars(handle_bars_p, stem_p, headset_p)),
+    }
+
+
+def _inputs(key: str, fmt: str, quality: str) -> str:
+    """Hash of everything a file depends on"""
+    data = [key, fmt, quality if fmt in MESH_FORMATS else None, _EXPORTER_HASH]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()[:32]
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write(fmt: str, data: Any, path: Path) -> float:
+    """Writes meshes and their names (mesh formats) or BREP data, returning the seconds it took"""
+    start = time.perf_counter()
+    tmp = path.with_name("%s.tmp%d%s" % (path.stem, os.getpid(), path.suffix))
+    if fmt in MESH_FORMATS:
+        MESH_FORMATS[fmt](tmp, *data)
+    elif fmt == "brep":
+        tmp.write_bytes(data)
+    else:
+        shapes = from_brep(data)
+        if fmt == "step":
+            export_step(shapes[0] if len(shapes) == 1 else Compound(shapes), str(tmp))
+            # Without the time of the export, so that the same shapes give the same file
+            tmp.write_bytes(re.sub(rb"(FILE_NAME\('[^']*',)'[^']*'", rb"\1'1980-01-01T00:00:00'", tmp.read_bytes(),
+                                   count=1))
+        else:
+            from bike_stem_mount.render import VIEWS, write_svg
+            write_svg(tmp, shapes, VIEWS["iso"])
+    os.replace(tmp, path)  # Atomic, so an interrupted export never leaves a partial file
+    return time.perf_counter() - start
+
+
+def _piece_meshes(shape: Shape, solid_meshes: dict[Shape, Mesh]) -> list[Mesh]:
+    solids, meshes, start = shape.solids(), [], 0
+    for size in piece_sizes(shape):
+        meshes.append(merge([solid_meshes[solid] for solid in solids[start:start + size]]))
+        start += size
+    return meshes
+
+
+def export_artifacts(formats: list[str], out_dir: Path = Path("artifacts"), names: Optional[list[str]] = None,
+                     quality: str = "print", config: Config = Config(), force: bool = False,
+                     max_workers: Optional[int] = None) -> dict[str, Any]:
+    """Exports the targets (default: all) as <target>.<format> files into out_dir, skipping those unchanged since the
+    previous export (unless forced), and returns the written manifest"""
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format %r (expected one of %s)" % (fmt, ", ".join(FORMATS)))
+    if quality not in QUALITY_PRESETS:
+        raise ValueError("Unknown quality %r (expected one of %s)" % (quality, ", ".join(QUALITY_PRESETS)))
+    start = time.perf_counter()
+    params = config.params()
+    all_targets = targets(**params)
+    for name in names or []:
+        if name not in all_targets:
+            raise ValueError("Unknown target %r (expected one of %s)" % (name, ", ".join(all_targets)))
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / MANIFEST
+    previous = json.loads(manifest_path.read_text())["files"] if manifest_path.exists() else {}
+
+    # Reuse the files whose inputs didn't change
+    files, pending = {}, {}
+    for name, (key, _) in all_targets.items():
+        if names and name not in names:
+            continue
+        for fmt in formats:
+            file, inputs = "%s.%s" % (name, fmt), _inputs(key, fmt, quality)
+            old = previous.get(file)
+            if not force and old and old["inputs"] == inputs and (out_dir / file).is_file() and \
+                    (out_dir / file).stat().st_size == old["size"]:
+                files[file] = {**old, "changed": False}
+            else:
+                pending.setdefault(name, []).append(fmt)
+                files[file] = {"target": name, "format": fmt, "key": key, "inputs": inputs}
+
+    # One build and tessellation for all the pending formats
+    timings = {"build": 0.0, "tessellation": 0.0}
+    build_start = time.perf_counter()
+    shapes = {name: all_targets[name][1]() for name in pending}
+    timings["build"] = time.perf_counter() - build_start
+    tessellation_start = time.perf_counter()
+    solids = list(dict.fromkeys(solid for name, shape in shapes.items()
+                                if any(fmt in MESH_FORMATS for fmt in pending[name]) for solid in shape.solids()))
+    solid_meshes = dict(zip(solids, tessellate_all(solids, QUALITY_PRESETS[quality], max_workers)))
+    timings["tessellation"] = time.perf_counter() - tessellation_start
+
+    jobs = {}
+    for name, shape in shapes.items():
+        meshes = _piece_meshes(shape, solid_meshes) if any(fmt in MESH_FORMATS for fmt in pending[name]) else None
+        data = to_brep([shape]) if any(fmt in SHAPE_FORMATS for fmt in pending[name]) else None
+        for fmt in pending[name]:
+            payload = (meshes, ["%s-%d" % (name, i) for i in range(len(meshes))]) if fmt in MESH_FORMATS else data
+            jobs["%s.%s" % (name, fmt)] = (fmt, payload, out_dir / ("%s.%s" % (name, fmt)))
+    if max_workers == 1 or len(jobs) <= 1:
+        seconds = {file: _write(*args) for file, args in jobs.items()}
+    else:
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = {file: pool.submit(_write, *args) for file, args in jobs.items()}
+            seconds = {file: future.result() for file, future in futures.items()}
+    for file, elapsed in seconds.items():
+        sha256 = _sha256(out_dir / file)
+        files[file].update(sha256=sha256, size=(out_dir / file).stat().st_size, seconds=round(elapsed, 3),
+                           changed=previous.get(file, {}).get("sha256") != sha256)
+    timings["total"] = time.perf_counter() - start
+
+    manifest = {
+        "quality": quality,
+        "parameters": {
+            "config": config.to_dict(),
+            "config_key": config.key(),
+            "global": {name: getattr(global_params, name) for name in _global_names()},
+            **{arg: dataclasses.asdict(value) for arg, value in params.items()},
+        },
+        "timings": {name: round(value, 3) for name, value in timings.items()},
+        "files": dict(sorted(files.items())),
+    }
+    tmp = manifest_path.with_name(MANIFEST + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp, manifest_path)
+    return manifest
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Exports the assembly and the parts in several formats, with a "
+                                                 "manifest of the files and the parameters")
+    parser.add_argument("targets", nargs="*", help="assembly, headset_screw, stem or handle_bars (default: all)")
+    parser.add_argument("--formats", default="stl,step", help="Comma-separated list of: " + ", ".join(FORMATS))
+    parser.add_argument("--out", default="artifacts", type=Path, help="Output directory")
+    parser.add_argument("--quality", choices=list(QUALITY_PRESETS), default="print")
+    parser.add_argument("--force", action="store_true", help="Export all files, even if unchanged")
+    parser.add_argument("--workers", type=int, default=None)
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        config = from_args(args)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+
+    manifest = export_artifacts(args.formats.lower().split(","), args.out, args.targets, args.quality, config,
+                                args.force, args.workers)
+    for file, entry in manifest["files"].items():
+        print("%-24s %s" % (file, ("exported in %.1fs" % entry["seconds"]) if entry["changed"] else "unchanged"))
+    print("%d files (%d changed) in %s, in %.1fs" % (len(manifest["files"]),
+                                                      sum(entry["changed"] for entry in manifest["files"].values()),
+                                                      args.out, manifest["timings"]["total"]))
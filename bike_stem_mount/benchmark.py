@@ -0,0 +1,216 @@
+# %%
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+# ================== BENCHMARKS ==================
+# Each benchmark runs in a fresh process (so that peak memory and import state are its own) with a temporary part cache
+# shared by all benchmarks. A "cold" run first loads the dependencies of the part and then times building it, while a
+# "warm" run times loading the already built part from the cache.
+#
+# The kernel settings of the booleans (see kernel.py) can also be compared against OCCT's defaults (serial and exact
+# booleans). As they are global parameters, each setting builds (and caches) the parts under its own keys.
+
+SERIAL_KERNEL = {"kernel_parallel": False, "kernel_fuzzy_fuse": 0, "kernel_fuzzy_cut": 0, "kernel_fuzzy_intersect": 0,
+                 "kernel_fuzzy_split": 0, "kernel_glue_fuse": False, "kernel_glue_cut": False}
+"""Kernel settings of OCCT's defaults"""
+
+
+def _headset_screw(_=None):
+    from bike_stem_mount.parts.headset_screw import build_headset_screw
+    return build_headset_screw()
+
+
+def _screwable_cylinder(_=None):
+    from bike_stem_mount.parts.screwable_cylinder import build_screwable_cylinder
+    return build_screwable_cylinder()
+
+
+def _stem_screw_holes(_=None):
+    from bike_stem_mount.parts.stem import build_stem_screw_holes
+    return build_stem_screw_holes()
+
+
+def _stem(_=None):
+    from bike_stem_mount.parts.stem import build_stem
+    return build_stem()
+
+
+def _handle_bars(_=None):
+    from bike_stem_mount.parts.handle_bars import build_handle_bars
+    return build_handle_bars()
+
+
+def _assembly(_=None):
+    from bike_stem_mount.main import build_assembly
+    return build_assembly(workers=1)
+
+
+def _export(fmt: str) -> Callable[[Any], Any]:
+    def export(assembly):
+        from build123d import export_step
+        from bike_stem_mount.export import export_mesh
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "assembly." + fmt)
+            if fmt == "step":
+                export_step(assembly, path)
+            else:
+                export_mesh(assembly, path)
+    return export
+
+
+@dataclass
+class Benchmark:
+    run: Callable[[Any], Any]
+    """Timed function, receiving the result of setup"""
+    setup: Callable[[], Any] = lambda: None
+    """Untimed, e.g. to load the dependencies of a part"""
+    cacheable: bool = True
+    """Whether to also time loading the result of run from the part cache"""
+
+
+BENCHMARKS = {
+    "headset_screw": Benchmark(_headset_screw),
+    "screwable_cylinder": Benchmark(_screwable_cylinder),
+    "stem_screw_holes": Benchmark(_stem_screw_holes),
+    "stem": Benchmark(_stem, lambda: (_headset_screw(), _stem_screw_holes())),
+    "handle_bars": Benchmark(_handle_bars, lambda: (_stem(), _screwable_cylinder())),
+    "assembly": Benchmark(_assembly, lambda: (_headset_screw(), _stem(), _handle_bars()), cacheable=False),
+    "export_stl": Benchmark(_export("stl"), _assembly, cacheable=False),
+    "export_3mf": Benchmark(_export("3mf"), _assembly, cacheable=False),
+    "export_step": Benchmark(_export("step"), _assembly, cacheable=False),
+}
+
+
+def _run(name: str, warm: bool, cache_dir: str, kernel: Optional[dict[str, Any]] = None) -> dict[str, float]:
+    from bike_stem_mount.cache import part_cache, peak_rss
+    import bike_stem_mount.main  # Don't time imports
+    if kernel:
+        from bike_stem_mount import kernel as kernel_module
+        from bike_stem_mount.parts import global_params
+        for setting, value in kernel.items():
+            setattr(global_params, setting, value)
+        kernel_module.install()
+    part_cache.enabled = True
+    part_cache.path = Path(cache_dir)
+    benchmark = BENCHMARKS[name]
+    arg = None if warm else benchmark.setup()
+    start = time.perf_counter()
+    benchmark.run(arg)
+    return {"seconds": time.perf_counter() - start, "peak_rss": peak_rss()}
+
+
+def run_benchmarks(names: list[str], repeat: int = 1,
+                   kernel: Optional[dict[str, Any]] = None) -> dict[str, dict[str, float]]:
+    """Best (minimum) time and peak memory of each benchmark, cold and warm if it is cacheable, optionally with the
+    given kernel settings"""
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name in names:
+            cacheable = BENCHMARKS[name].cacheable
+            for warm in ([False, True] if cacheable else [False]):
+                label = name + ("_warm" if warm else "_cold" if cacheable else "")
+                runs = []
+                for i in range(repeat):
+                    if not warm:  # Each cold run must build the part again
+                        for file in Path(cache_dir).glob(name + "-*.brep"):
+                            file.unlink()
+                    with ProcessPoolExecutor(1, max_tasks_per_child=1) as pool:
+                        runs.append(pool.submit(_run, name, warm, cache_dir, kernel).result())
+                results[label] = {"seconds": min(r["seconds"] for r in runs),
+                                  "peak_rss": min(r["peak_rss"] for r in runs)}
+                print("%-28s %9.3fs %9.1f MB" % (label, results[label]["seconds"],
+                                                  results[label]["peak_rss"] / 2 ** 20), flush=True)
+    return results
+
+
+def compare_kernel(names: list[str], repeat: int, kernel: dict[str, Any]) -> dict[str, dict[str, dict[str, float]]]:
+    """Results with OCCT's default and with the given kernel settings, printing the speedup of each benchmark"""
+    results = {}
+    for mode, settings in (("default", SERIAL_KERNEL), ("configured", kernel)):
+        print("Kernel settings (%s): %s" % (mode, ", ".join("%s=%s" % item for item in settings.items())), flush=True)
+        results[mode] = run_benchmarks(names, repeat, settings)
+    print("%-28s %10s %10s %8s" % ("", "default", "configured", "speedup"))
+    for label, result in results["configured"].items():
+        old, new = results["default"][label]["seconds"], result["seconds"]
+        print("%-28s %9.3fs %9.3fs %7.2fx" % (label, old, new, old / new if new else float("inf")))
+    return results
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]],
+            time_threshold: float, memory_threshold: float) -> list[str]:
+    """Regressions of results with respect to the baseline, as relative thresholds (0.2 = 20% worse)"""
+    regressions = []
+    for label, result in results.items():
+        if label not in baseline:
+            continue
+        for metric, threshold in (("seconds", time_threshold), ("peak_rss", memory_threshold)):
+            old, new = baseline[label][metric], result[metric]
+            if new > old * (1 + threshold):
+                regressions.append("%s %s: %.4g -> %.4g (+%.0f%%, threshold %.0f%%)" % (
+                    label, metric, old, new, (new / old - 1) * 100, threshold * 100))
+    return regressions
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Benchmarks building and exporting the parts")
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per benchmark (the best one is kept)")
+    parser.add_argument("--baseline", type=Path, default=Path("benchmark-baseline.json"))
+    parser.add_argument("--save", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--time-threshold", type=float, default=0.25, help="Allowed relative time regression")
+    parser.add_argument("--memory-threshold", type=float, default=0.15, help="Allowed relative memory regression")
+    parser.add_argument("--output", type=Path, help="Also write the results to this JSON file")
+    parser.add_argument("--kernel", action="store_true",
+                        help="Compare the kernel settings of the global parameters (see --set global.kernel_...) "
+                             "against OCCT's defaults, instead of checking for regressions")
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        from_args(args).apply()
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+
+    if args.kernel:
+        from bike_stem_mount import kernel
+        results = compare_kernel(args.only or list(BENCHMARKS), args.repeat, kernel.settings())
+        document = {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                    "kernel": kernel.settings(), "results": results}
+        if args.output:
+            args.output.write_text(json.dumps(document, indent=2))
+        sys.exit(0)
+
+    results = run_benchmarks(args.only or list(BENCHMARKS), args.repeat)
+    document = {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+    try:
+        import build123d
+        document["build123d"] = getattr(build123d, "__version__", None)
+    except ImportError:
+        pass
+    if args.output:
+        args.output.write_text(json.dumps(document, indent=2))
+
+    if args.save:
+        if args.baseline.exists():  # Keep the benchmarks that were not run this time
+            document["results"] = {**json.loads(args.baseline.read_text())["results"], **results}
+        args.baseline.write_text(json.dumps(document, indent=2))
+        print("Saved baseline to %s" % args.baseline)
+    elif args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text())["results"],
+                              args.time_threshold, args.memory_threshold)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions with respect to %s" % args.baseline)
+    else:
+        print("No baseline at %s (use --save to create it)" % args.baseline)
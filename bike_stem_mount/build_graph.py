@@ -0,0 +1,106 @@
+# %%
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+from bike_stem_mount.cache import from_brep, part_cache, scoped_build, to_brep
+from bike_stem_mount.parts.headset_screw import HeadsetScrewParams, build_headset_screw, headset_screw_key, \
+    p as headset_p
+from bike_stem_mount.parts.stem import StemParams, build_stem, build_stem_screw_holes, stem_key, \
+    stem_screw_holes_key, p as stem_p
+from bike_stem_mount.parts.handle_bars import HandleBarParams, build_handle_bars, handle_bars_key, \
+    screwable_cylinder_kwargs, p as handle_bars_p
+from bike_stem_mount.parts.screwable_cylinder import build_screwable_cylinder, screwable_cylinder_key
+
+# ================== BUILD GRAPH ==================
+# Independent parts are built in parallel by worker processes. Each node just calls a regular (cached) part builder,
+# after seeding the cache of the worker with the BREP of its dependencies, so the same builders work without the graph.
+
+
+@dataclass
+class Node:
+    key: str
+    """Part cache key of the result of build"""
+    build: Callable[..., Any]
+    """Module-level (picklable) part builder, that stores its result in the part cache"""
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    deps: tuple[str, ...] = ()
+    """Keys of the nodes that build requires"""
+
+
+def seed(parts: dict[str, bytes]):
+    """Loads parts serialized by another process into the part cache of this one"""
+    for key, data in parts.items():
+        part_cache.remember(key, from_brep(data))
+
+
+def _run_node(node: Node, deps: dict[str, bytes]) -> bytes:
+    with scoped_build():  # Workers are reused: release everything but the result
+        seed(deps)
+        node.build(*node.args, **node.kwargs)
+        return to_brep(part_cache.recall(node.key))
+
+
+def run(nodes: list[Node], max_workers: Optional[int] = None, raise_errors: bool = True) -> dict[str, BaseException]:
+    """Builds the nodes that are not cached yet in a process pool, loading the results into the part cache.
+
+    If raise_errors, the first error stops the build. Otherwise, the nodes that failed or depend on a failed node
+    are skipped and returned with their error."""
+    todo = {node.key: node for node in nodes if not part_cache.contains(node.key)}
+    failed: dict[str, BaseException] = {}
+    if not todo:
+        return failed
+    data: dict[str, bytes] = {}
+
+    def dep_data(key: str) -> Optional[bytes]:
+        if key not in data:
+            shapes = part_cache.recall(key)
+            if shapes is None:  # Not part of the graph: the worker will build it
+                return None
+            data[key] = to_brep(shapes)
+        return data[key]
+
+    with ProcessPoolExecutor(max_workers) as pool:
+        running = {}
+        while todo or running:
+            running_keys = {node.key for node in running.values()}
+            for key, node in list(todo.items()):
+                failed_dep = next((dep for dep in node.deps if dep in failed), None)
+                if failed_dep is not None:
+                    failed[key] = failed[failed_dep]
+                    del todo[key]
+                    continue
+                if any(dep in todo or dep in running_keys for dep in node.deps):
+                    continue
+                deps = {dep: dep_data(dep) for dep in node.deps}
+                running[pool.submit(_run_node, node, {k: v for k, v in deps.items() if v is not None})] = node
+                del todo[key]
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    if raise_errors:
+                        raise error
+                    failed[node.key] = error
+                    continue
+                data[node.key] = future.result()
+                part_cache.remember(node.key, from_brep(data[node.key]))
+    return failed
+
+
+def assembly_nodes(headset_p: HeadsetScrewParams = headset_p, stem_p: StemParams = stem_p,
+                   handle_bars_p: HandleBarParams = handle_bars_p) -> list[Node]:
+    """The parts of the assembly and their real dependencies"""
+    headset_screw = headset_screw_key(headset_p)
+    stem_screw_holes = stem_screw_holes_key(stem_p)
+    stem = stem_key(stem_p, headset_p)
+    handle_bars_cylinder = screwable_cylinder_key(**screwable_cylinder_kwargs)
+    return [
+        Node(headset_screw, build_headset_screw, (headset_p,)),
+        Node(stem_screw_holes, build_stem_screw_holes, (stem_p,)),
+        Node(handle_bars_cylinder, build_screwable_cylinder, kwargs=screwable_cylinder_kwargs),
+        Node(stem, build_stem, (stem_p, headset_p), deps=(headset_screw, stem_screw_holes)),
+        Node(handle_bars_key(handle_bars_p, stem_p, headset_p), build_handle_bars, (handle_bars_p, stem_p, headset_p),
+             deps=(stem, handle_bars_cylinder)),
+    ]
@@ -0,0 +1,433 @@
+# %%
+from __future__ import annotations
+import ast
+import contextlib
+import dataclasses
+import functools
+import gc
+import hashlib
+import json
+import marshal
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from importlib import metadata
+from typing import TYPE_CHECKING, Any, Callable, Generic, Iterator, Optional, TypeVar
+from bike_stem_mount.parts import global_params
+
+if TYPE_CHECKING:  # build123d and OCP are only imported to (de)serialize shapes, so that keys are cheap to compute
+    from build123d import Shape
+
+# ================== PART CACHE ==================
+# Built parts are stored as BREP files named after a hash of everything that may change their geometry: the parameter
+# dataclasses, the global parameters, the keys of the upstream parts and the source code of their modelling scripts.
+
+_PACKAGE_DIR = Path(__file__).parent
+_PARTS_DIR = _PACKAGE_DIR / "parts"
+_KERNEL_MODULES = [__package__ + ".kernel", __package__ + ".robust"]
+"""Modules deciding the result of the booleans and fillets of every part (OCCT settings, fallbacks)"""
+
+
+def _canonical(obj: Any) -> Any:
+    """Converts parameters to a JSON-serializable form that only depends on their values"""
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {"__type__": type(obj).__name__,
+                **{f.name: _canonical(getattr(obj, f.name)) for f in dataclasses.fields(obj)}}
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in sorted(obj.items())}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, float):
+        return "%.9g" % obj  # Ignores floating point noise from geometry-derived defaults
+    if obj is None or isinstance(obj, (bool, int, str)):
+        return obj
+    return repr(obj)
+
+
+def _global_params() -> dict:
+    return {k: v for k, v in vars(global_params).items()
+            if not k.startswith("_") and isinstance(v, (int, float))}
+
+
+def module_path(module: str) -> Path:
+    """Source file of a module of this package (which may not exist)"""
+    path = _PACKAGE_DIR.parent.joinpath(*module.split("."))
+    return path / "__init__.py" if path.is_dir() else path.with_suffix(".py")
+
+
+def module_imports(module: str) -> set[str]:
+    """The modules of this package imported by the source of module when it is loaded: outside of its __main__ block
+    and of functions (which import when called, e.g. validate.validate() imports main)"""
+    tree = ast.parse(module_path(module).read_bytes())
+    todo = [node for node in tree.body if not (isinstance(node, ast.If) and "__main__" in ast.unparse(node.test))]
+    names = set()
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            continue
+        todo.extend(ast.iter_child_nodes(node))
+        if isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.add(node.module)
+            names.update(node.module + "." + alias.name for alias in node.names)  # Submodules
+        elif isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+    return {name for name in names if name.startswith(__package__ + ".") and module_path(name).is_file()}
+
+
+def _source_hash(module: Optional[str] = None) -> str:
+    """Hash of the source of module and the part scripts it (indirectly) imports, or of all part scripts, and of the
+    kernel modules"""
+    if module is None or not module_path(module).is_file():  # E.g. __main__
+        paths = set(_PARTS_DIR.glob("*.py"))
+    else:
+        modules, todo = set(), [module]
+        while todo:
+            name = todo.pop()
+            if name not in modules:
+                modules.add(name)
+                todo.extend(dep for dep in module_imports(name) if dep.startswith(__package__ + ".parts."))
+        paths = {module_path(name) for name in modules}
+    paths |= {module_path(name) for name in _KERNEL_MODULES}
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        h.update(path.name.encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+@functools.cache
+def _build123d_version() -> Optional[str]:
+    try:
+        return metadata.version("build123d")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def to_brep(shapes: list[Shape]) -> bytes:
+    """Serializes the shapes, in order, as a BREP compound"""
+    from build123d import Compound, export_brep
+    buffer = BytesIO()
+    export_brep(Compound(list(shapes)), buffer)
+    return buffer.getvalue()
+
+
+def from_brep(data: bytes) -> list[Shape]:
+    """Inverse of to_brep"""
+    from build123d import Compound
+    from OCP.BRep import BRep_Builder
+    from OCP.BRepTools import BRepTools
+    from OCP.TopoDS import TopoDS_Shape
+    shape = TopoDS_Shape()
+    BRepTools.Read_s(shape, BytesIO(data), BRep_Builder())
+    if shape.IsNull():
+        raise ValueError("Invalid BREP data")
+    return list(Compound.cast(shape))
+
+
+class PartCache:
+    """Size-bounded (LRU) on-disk cache of built shapes"""
+
+    def __init__(self, path: Optional[os.PathLike] = None, max_size: Optional[int] = None):
+        self.path = Path(path or os.environ.get("BIKE_STEM_MOUNT_CACHE_DIR") or
+                         Path.home() / ".cache" / "bike_stem_mount")
+        self.max_size = max_size if max_size is not None else \
+            int(os.environ.get("BIKE_STEM_MOUNT_CACHE_SIZE", 256 * 1024 * 1024))
+        self.enabled = os.environ.get("BIKE_STEM_MOUNT_CACHE", "1") != "0"
+        self._source_hashes: dict[Optional[str], str] = {}
+        self._memo: dict[str, list[Shape]] = {}  # Shapes already loaded or built by this process
+
+    def key(self, name: str, *inputs: Any, module: Optional[str] = None) -> str:
+        """Hash of a part's name, its inputs (parameters and upstream keys) and everything global it depends on: the
+        source of the module that builds it and of the part scripts it imports (all part scripts if not given)"""
+        data = json.dumps(_canonical({
+            "name": name,
+            "inputs": list(inputs),
+            "global_params": _global_params(),
+            "source": self.source_hash(module),
+            "build123d": _build123d_version(),
+        }), sort_keys=True)
+        return name + "-" + hashlib.sha256(data.encode()).hexdigest()[:32]
+
+    def source_hash(self, module: Optional[str] = None) -> str:
+        """_source_hash(module), until invalidate_sources()"""
+        if module not in self._source_hashes:
+            self._source_hashes[module] = _source_hash(module)
+        return self._source_hashes[module]
+
+    def _file(self, key: str) -> Path:
+        return self.path / (key + ".brep")
+
+    def get(self, key: str) -> Optional[list[Shape]]:
+        """The shapes stored for the key, or None on a miss"""
+        if not self.enabled:
+            return None
+        file = self._file(key)
+        try:
+            shapes = from_brep(file.read_bytes())
+        except Exception:  # Missing or corrupt
+            return None
+        try:
+            os.utime(file)  # Most recently used
+        except OSError:
+            pass
+        return shapes
+
+    def put(self, key: str, shapes: list[Shape], data: Optional[bytes] = None):
+        """Stores the shapes, optionally already serialized by to_brep"""
+        if not self.enabled:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        file = self._file(key)
+        tmp = file.with_suffix(".tmp%d" % os.getpid())
+        tmp.write_bytes(data if data is not None else to_brep(shapes))
+        os.replace(tmp, file)  # Atomic, for concurrent builds
+        self.evict()
+
+    def invalidate_sources(self):
+        """Hashes the source of the part scripts again on the next key (of a part or stage), after they changed"""
+        self._source_hashes.clear()
+
+    def contains(self, key: str) -> bool:
+        return key in self._memo or (self.enabled and self._file(key).exists())
+
+    def remember(self, key: str, shapes: list[Shape]):
+        """Makes the shapes available to this process only, e.g. when built by another one"""
+        self._memo[key] = list(shapes)
+
+    def recall(self, key: str) -> Optional[list[Shape]]:
+        """The shapes for the key from memory or disk, without building them"""
+        shapes = self._memo.get(key)
+        if shapes is None:
+            shapes = self.get(key)
+            if shapes is not None:
+                self._memo[key] = shapes
+        return shapes
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size"""
+        entries = []
+        for file in self.path.glob("*.brep"):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= self.max_size:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+
+    def retain(self, keys: set[str]):
+        """Forgets the shapes in memory except those of keys (they stay on disk)"""
+        for key in list(self._memo):
+            if key not in keys:
+                del self._memo[key]
+
+    def clear(self):
+        self._memo.clear()
+        for file in self.path.glob("*.brep"):
+            file.unlink(missing_ok=True)
+
+    def cached(self, key: str, build: Callable[[], list[Shape]]) -> list[Shape]:
+        """Returns the shapes for the key from memory or disk, or builds and stores them"""
+        shapes = self.recall(key)
+        if shapes is None:
+            data = to_brep(list(_measure(key.rsplit("-", 1)[0], build)))
+            # As loaded from the BREP (with the locations baked in the geometry), so that the later stages see the same
+            # shapes whether this part was just built, loaded from disk or built by another process
+            shapes = from_brep(data)
+            self.put(key, shapes, data)
+            self._memo[key] = shapes
+        return shapes
+
+
+part_cache = PartCache()
+
+
+# ================== STAGE CACHE ==================
+# The modelling scripts are split into named stages, each declaring the parameters it reads and the stages it builds
+# on. Intermediate results are kept in memory only (they are cheap to recompute compared to a whole part), so that
+# tweaking a late-stage parameter while developing a part only reruns the stages downstream of it.
+
+T = TypeVar("T")
+
+
+@dataclasses.dataclass
+class Stage(Generic[T]):
+    key: str
+    value: T
+    """Shared with later runs of the stage with the same inputs: copy shapes before mutating them (e.g. joints)"""
+
+
+def shapes_key(shapes: list[Shape]) -> str:
+    """Hash of the geometry of the shapes, to depend on shapes rather than on everything that built them"""
+    return hashlib.sha256(to_brep(shapes)).hexdigest()[:32]
+
+
+class StageCache:
+    """Bounded (LRU) in-memory cache of the results of modelling stages"""
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self.enabled = os.environ.get("BIKE_STEM_MOUNT_CACHE", "1") != "0"
+        self.hits = self.misses = 0
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+
+    def key(self, name: str, build: Callable[[], Any], params: tuple = (), deps: tuple = ()) -> str:
+        """Hash of the stage name, its declared parameters, its upstream stage (or part) keys, its code and the source
+        of its module (with the part scripts it imports, e.g. helpers the stage calls)"""
+        data = json.dumps(_canonical({
+            "name": name,
+            "params": list(params),
+            "deps": [dep.key if isinstance(dep, Stage) else dep for dep in deps],
+            "source": part_cache.source_hash(build.__module__),
+        }), sort_keys=True).encode() + marshal.dumps(build.__code__)
+        return name + "-" + hashlib.sha256(data).hexdigest()[:32]
+
+    def run(self, name: str, build: Callable[[], T], params: tuple = (), deps: tuple = ()) -> Stage[T]:
+        """Runs build, unless a stage with the same name, code and inputs ran before.
+
+        build must only read the given params and the values of the deps (stages or part keys), as anything else it
+        reads (e.g. from an enclosing function) is not part of the key."""
+        key = self.key(name, build, params, deps)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return Stage(key, self._entries[key])
+        self.misses += 1
+        value = _measure(name, build)
+        if self.enabled and _scope is None:  # Within a scoped build, freed once the part using it is built
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return Stage(key, value)
+
+    def clear(self):
+        self._entries.clear()
+
+
+stage_cache = StageCache()
+
+
+# ================== SCOPED BUILDS ==================
+# Stage results and parts stay in memory so that rebuilds are fast, which suits an interactive session but not a
+# worker process building variant after variant. Within a scoped build, stage results aren't kept in the stage cache,
+# so they are freed as soon as the part they belong to is built, and the parts loaded or built are released when it ends
+# (collecting the reference cycles between build123d objects, e.g. joints, so that their OCCT shapes are freed right
+# away). The time and peak resident memory of each stage (and part) are recorded. On Linux, the peak of the process is
+# reset before each stage, so peaks are per stage, otherwise they are the peaks so far.
+
+
+def rss() -> int:
+    """Current resident memory of this process in bytes (peak memory if not available)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes, since the last reset_peak_rss()"""
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, ValueError, StopIteration):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak of peak_rss() to the current memory, if supported (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@dataclasses.dataclass
+class StageMemory:
+    name: str
+    depth: int
+    """Number of stages (or parts) running it, e.g. a stage of a part built by another stage"""
+    seconds: float
+    rss_before: int
+    rss_after: int
+    peak: int
+    """Peak resident memory while running, including the stages it ran"""
+
+
+class BuildScope:
+    """Stages (and parts) run within a scoped build, and the memory they used"""
+
+    def __init__(self):
+        self.stages: list[StageMemory] = []
+        self.peak = 0
+        """Peak resident memory of the whole scope"""
+        self.released = 0
+        """Resident memory after releasing everything"""
+        self._running: list[StageMemory] = []
+
+    def report(self) -> str:
+        lines = ["%-32s %8s %10s %10s %10s" % ("stage", "seconds", "before MB", "after MB", "peak MB")]
+        for stage in self.stages:
+            lines.append("%-32s %8.2f %10.1f %10.1f %10.1f" % ("  " * stage.depth + stage.name, stage.seconds,
+                                                             stage.rss_before / 2 ** 20, stage.rss_after / 2 ** 20,
+                                                             stage.peak / 2 ** 20))
+        lines.append("Peak %.1f MB, %.1f MB after releasing the parts" % (self.peak / 2 ** 20, self.released / 2 ** 20))
+        return "\n".join(lines)
+
+
+_scope: Optional[BuildScope] = None
+
+
+def _measure(name: str, build: Callable[[], T]) -> T:
+    """Runs build, recording it in the current scoped build if any"""
+    if _scope is None:
+        return build()
+    stage = StageMemory(name, len(_scope._running), 0.0, rss(), 0, 0)
+    if _scope._running:  # Keep the peak of the enclosing stages before resetting it
+        _scope._running[-1].peak = max(_scope._running[-1].peak, peak_rss())
+    _scope.stages.append(stage)
+    _scope._running.append(stage)
+    reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        return build()
+    finally:
+        stage.seconds = time.perf_counter() - start
+        stage.rss_after = rss()
+        stage.peak = max(stage.peak, peak_rss())
+        _scope._running.pop()
+        if _scope._running:
+            _scope._running[-1].peak = max(_scope._running[-1].peak, stage.peak)
+        _scope.peak = max(_scope.peak, stage.peak)
+
+
+@contextlib.contextmanager
+def scoped_build() -> Iterator[BuildScope]:
+    """Doesn't keep the stage results of the builds within it, and releases the parts they kept in memory when it ends,
+    measuring them. Nested scoped builds are part of the outermost one."""
+    global _scope
+    if _scope is not None:
+        yield _scope
+        return
+    scope, parts = BuildScope(), set(part_cache._memo)
+    reset_peak_rss()
+    _scope = scope
+    try:
+        yield scope
+    finally:
+        _scope = None
+        scope.peak = max(scope.peak, peak_rss())
+        part_cache.retain(parts)
+        gc.collect()
+        scope.released = rss()
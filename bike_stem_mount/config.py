@@ -0,0 +1,291 @@
+# %%
+import argparse
+import ast
+import dataclasses
+import hashlib
+import importlib
+import json
+import math
+import tomllib
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Union
+from bike_stem_mount.cache import _canonical, module_path
+from bike_stem_mount.parts.fasteners import lookup
+
+# ================== CONFIGURATION ==================
+# Parameters can be given as TOML/JSON files and "<section>.<field>=<value>" overrides instead of editing the dataclass
+# defaults. All of them are checked (names, types and values) before anything is built, and kept as a sorted tuple of
+# overrides, which is hashable and the same for any equivalent configuration.
+#
+# The global and screwable_cylinder sections change process-wide settings: the global parameters (recomputing those
+# derived from them) and the kwargs of the ScrewableCylinder of each part. The modules using the global parameters are
+# reloaded, as they are read at import time (e.g. by dataclass defaults).
+
+GLOBAL_MODULE = "bike_stem_mount.parts.global_params"
+PART_SECTIONS = {
+    "headset": ("bike_stem_mount.parts.headset_screw", "HeadsetScrewParams", "headset_p"),
+    "stem": ("bike_stem_mount.parts.stem", "StemParams", "stem_p"),
+    "handle_bars": ("bike_stem_mount.parts.handle_bars", "HandleBarParams", "handle_bars_p"),
+}
+"""Module, parameter dataclass and build_assembly() argument of each part section"""
+SCREWABLE_CYLINDER_MODULE = "bike_stem_mount.parts.screwable_cylinder"
+SCREWABLE_CYLINDER_USERS = ["bike_stem_mount.parts.stem", "bike_stem_mount.parts.handle_bars"]
+"""Modules with a screwable_cylinder_kwargs dict"""
+SECTIONS = ["global", *PART_SECTIONS, "screwable_cylinder"]
+
+POSITIVE = ("a positive number", lambda value: value > 0)
+INCREASING = ("an increasing pair of positive numbers", lambda value: 0 < value[0] < value[1])
+CONSTRAINTS = {
+    **{("headset", field): POSITIVE for field in ("screw_radius", "screw_flat_radius", "circle_flat_radius",
+                                                  "circle_radius", "circle_max_height")},
+    ("stem", "range"): INCREASING,
+    **{("stem", field): POSITIVE for field in ("width", "height", "fillet")},
+    **{("handle_bars", field): POSITIVE for field in ("width", "height", "radius")},
+    **{("screwable_cylinder", field): POSITIVE for field in ("screw_length", "screw_diameter", "screw_head_diameter",
+                                                             "screw_head_height", "nut_inscribed_diameter",
+                                                             "nut_height", "wall_size")},
+}
+"""(Description, check) of the values allowed for part and screwable_cylinder parameters (the global ones must be
+positive, or non-negative if their default is 0). Fillet radii must be positive too, as the fillets can't be skipped"""
+
+
+class ConfigError(ValueError):
+    """Invalid configuration (with all the problems found)"""
+
+
+def parse_value(text: str) -> Any:
+    """Python literal (number, tuple...), true/false (as in TOML) or plain string"""
+    if text.strip() in ("true", "false"):
+        return text.strip() == "true"
+    try:
+        return ast.literal_eval(text.strip())
+    except (ValueError, SyntaxError):
+        return text.strip()
+
+
+def _global_names() -> list[str]:
+    """The parameters assigned by global_params.py (not its upper case units)"""
+    tree = ast.parse(module_path(GLOBAL_MODULE).read_bytes())
+    return [target.id for node in tree.body if isinstance(node, ast.Assign)
+            for target in node.targets if isinstance(target, ast.Name) and not target.id.isupper()]
+
+
+def _global_values(overrides: dict[str, float]) -> dict[str, float]:
+    """The global parameters with the given overrides, and the others computed by global_params.py from them"""
+    class Pinned(dict):
+        def __setitem__(self, key, value):
+            if key not in overrides:
+                super().__setitem__(key, value)
+    values = Pinned(overrides)
+    exec(compile(module_path(GLOBAL_MODULE).read_bytes(), str(module_path(GLOBAL_MODULE)), "exec"),
+         {"__name__": GLOBAL_MODULE}, values)
+    return {name: values[name] for name in _global_names()}
+
+
+def _class_fields(module: str, cls: str) -> dict[str, Any]:
+    """Type of each annotated field of a class, read from the source of its module (without importing it, and so
+    build123d, to check parameters quickly)"""
+    tree = ast.parse(module_path(module).read_bytes())
+    node = next(node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == cls)
+    names = {**vars(typing), "float": float, "int": int, "bool": bool, "str": str, "tuple": tuple}
+    fields = {}
+    for item in node.body:
+        if isinstance(item, ast.AnnAssign) and isinstance(item.target, ast.Name):
+            try:
+                fields[item.target.id] = eval(ast.unparse(item.annotation), names)
+            except NameError:  # E.g. build123d types, which can't be configured
+                fields[item.target.id] = None
+    return fields
+
+
+def _fields(section: str) -> dict[str, Any]:
+    """Type of each configurable field of a section"""
+    if section == "global":
+        return {name: bool if isinstance(value, bool) else float for name, value in _global_values({}).items()}
+    if section == "screwable_cylinder":
+        tree = ast.parse(module_path(SCREWABLE_CYLINDER_MODULE).read_bytes())
+        placement = next(ast.literal_eval(node.value) for node in tree.body if isinstance(node, ast.Assign) and
+                         any(isinstance(target, ast.Name) and target.id == "_PLACEMENT_FIELDS"
+                             for target in node.targets))
+        return {name: kind for name, kind in _class_fields(SCREWABLE_CYLINDER_MODULE, "ScrewableCylinder").items()
+                if name not in placement}
+    module, cls, _ = PART_SECTIONS[section]
+    return _class_fields(module, cls)
+
+
+def _coerce(value: Any, kind: Any) -> Any:
+    """The value as the given type annotation (ints as floats, lists as tuples...), or TypeError"""
+    origin, args = typing.get_origin(kind), typing.get_args(kind)
+    if origin is Union:
+        if value is None and type(None) in args:
+            return None
+        for arg in args:
+            if arg is not type(None):
+                try:
+                    return _coerce(value, arg)
+                except TypeError:
+                    pass
+        raise TypeError("expected %s" % " or ".join(getattr(arg, "__name__", str(arg)) for arg in args))
+    if origin is tuple:
+        kinds = [args[0]] * len(value) if len(args) == 2 and args[1] is ... and isinstance(value, (list, tuple)) \
+            else list(args)
+        if not isinstance(value, (list, tuple)) or len(value) != len(kinds):
+            raise TypeError("expected a list of %d values" % len(kinds))
+        return tuple(_coerce(item, item_kind) for item, item_kind in zip(value, kinds))
+    if kind is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        if not math.isfinite(value):
+            raise TypeError("expected a finite number")
+        return float(value)
+    if kind in (int, bool, str) and type(value) is kind:
+        return value
+    raise TypeError("expected %s" % getattr(kind, "__name__", kind))
+
+
+@dataclass(frozen=True)
+class Config:
+    overrides: tuple[tuple[str, str, Any], ...] = ()
+    """Sorted (section, field, value) of each overridden parameter, with normalized values"""
+
+    def section(self, name: str) -> dict[str, Any]:
+        return {field: value for section, field, value in self.overrides if section == name}
+
+    def to_dict(self) -> dict[str, dict[str, Any]]:
+        """Nested like the TOML and JSON files"""
+        return {name: self.section(name) for name in SECTIONS if self.section(name)}
+
+    def key(self) -> str:
+        """Hash of the configuration"""
+        return hashlib.sha256(json.dumps(_canonical(self.overrides)).encode()).hexdigest()[:32]
+
+    def merged(self, other: "Config") -> "Config":
+        """This configuration with the overrides of other (which take precedence)"""
+        values = {(section, field): value for section, field, value in self.overrides + other.overrides}
+        return Config(tuple(sorted((section, field, value) for (section, field), value in values.items())))
+
+    def apply(self):
+        """Sets the process-wide (global and screwable_cylinder) parameters, resetting those not overridden"""
+        global_params = importlib.import_module(GLOBAL_MODULE)
+        values = _global_values(self.section("global"))
+        if any(getattr(global_params, name) != value for name, value in values.items()):
+            from bike_stem_mount.watch import affected_modules
+            for name, value in values.items():
+                setattr(global_params, name, value)
+            for module in affected_modules({GLOBAL_MODULE}):
+                if module != GLOBAL_MODULE:
+                    importlib.reload(importlib.import_module(module))
+            importlib.import_module("bike_stem_mount.kernel").install()
+        placement = importlib.import_module(SCREWABLE_CYLINDER_MODULE)._PLACEMENT_FIELDS
+        for module in SCREWABLE_CYLINDER_USERS:
+            kwargs = importlib.import_module(module).screwable_cylinder_kwargs
+            for name in [name for name in kwargs if name not in placement]:
+                del kwargs[name]
+            kwargs.update(self.section("screwable_cylinder"))
+
+    def params(self) -> dict[str, Any]:
+        """Applies the process-wide parameters, and returns the parameter dataclasses of the parts (as build_assembly()
+        arguments)"""
+        self.apply()
+        return {arg: dataclasses.replace(getattr(importlib.import_module(module), "p"), **self.section(section))
+                for section, (module, _, arg) in PART_SECTIONS.items()}
+
+
+def parse_config(data: dict[str, Any]) -> Config:
+    """Validates parameters nested by section (like the TOML and JSON files), raising a ConfigError with all the
+    problems found"""
+    overrides, errors = [], []
+    for section, values in data.items():
+        if section not in SECTIONS:
+            errors.append("Unknown section %r (expected one of %s)" % (section, ", ".join(SECTIONS)))
+            continue
+        if not isinstance(values, dict):
+            errors.append("Section %r must be a table of parameters" % section)
+            continue
+        fields = _fields(section)
+        defaults = _global_values({}) if section == "global" else {}
+        for field, value in values.items():
+            if field not in fields:
+                errors.append("Unknown parameter %s.%s (expected one of %s)" % (section, field, ", ".join(fields)))
+                continue
+            try:
+                value = _coerce(value, fields[field])
+            except TypeError as ex:
+                errors.append("Invalid %s.%s = %r: %s" % (section, field, value, ex))
+                continue
+            if section == "global" and fields[field] is float and (value < 0 or value == 0 and defaults[field] > 0):
+                errors.append("Invalid %s.%s = %r: expected a %s number" % (
+                    section, field, value, "positive" if defaults[field] > 0 else "non-negative"))
+                continue
+            expected, check = CONSTRAINTS.get((section, field), (None, None))
+            if check is not None and value is not None and not check(value):
+                errors.append("Invalid %s.%s = %r: expected %s" % (section, field, value, expected))
+                continue
+            if section == "screwable_cylinder" and field == "fastener" and value is not None:
+                try:
+                    lookup(value)
+                except ValueError as ex:
+                    errors.append("Invalid %s.%s: %s" % (section, field, ex))
+                    continue
+            overrides.append((section, field, value))
+    if errors:
+        raise ConfigError("\n".join(errors))
+    return Config(tuple(sorted(overrides)))
+
+
+def parse_overrides(overrides: dict[str, Any]) -> Config:
+    """Validates {"<section>.<field>": value} overrides"""
+    data = {}
+    for name, value in overrides.items():
+        section, sep, field = name.partition(".")
+        if not sep:
+            raise ConfigError("Invalid parameter %r (expected <section>.<field>)" % name)
+        data.setdefault(section, {})[field] = value
+    return parse_config(data)
+
+
+def load_config(path: Path) -> Config:
+    """Parameters from a TOML or JSON (by extension) file"""
+    path = Path(path)
+    try:
+        data = tomllib.loads(path.read_text()) if path.suffix.lower() == ".toml" else json.loads(path.read_text())
+    except (OSError, ValueError) as ex:
+        raise ConfigError("Cannot read %s: %s" % (path, ex))
+    if not isinstance(data, dict):
+        raise ConfigError("%s must contain a table of sections" % path)
+    return parse_config(data)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--config", nargs="*", type=Path, default=[],
+                        help="TOML or JSON parameter files (later ones take precedence)")
+    parser.add_argument("--set", nargs="*", default=[], metavar="SECTION.FIELD=VALUE",
+                        help="Parameter overrides, e.g. stem.angle=-5 global.tol=0.25 (sections: %s)" %
+                        ", ".join(SECTIONS))
+
+
+def from_args(args: argparse.Namespace) -> Config:
+    """The configuration of the --config and --set arguments (see add_arguments)"""
+    config = Config()
+    for path in args.config:
+        config = config.merged(load_config(path))
+    overrides = {}
+    for override in args.set:
+        name, sep, value = override.partition("=")
+        if not sep:
+            raise ConfigError("Invalid override %r (expected <section>.<field>=<value>)" % override)
+        overrides[name.strip()] = parse_value(value)
+    return config.merged(parse_overrides(overrides))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validates parameter files and overrides, printing the resulting "
+                                                 "configuration and its key")
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        config = from_args(args)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+    print(json.dumps(config.to_dict(), indent=2))
+    print("Key: %s" % config.key())
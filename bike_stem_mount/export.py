@@ -0,0 +1,299 @@
+# %%
+import argparse
+import io
+import json
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from build123d import Compound, Shape
+from OCP.BRep import BRep_Tool
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+from OCP.IMeshTools import IMeshTools_Parameters
+from OCP.TopAbs import TopAbs_FACE, TopAbs_REVERSED
+from OCP.TopExp import TopExp_Explorer
+from OCP.TopLoc import TopLoc_Location
+from OCP.TopoDS import TopoDS
+from bike_stem_mount import kernel
+from bike_stem_mount.cache import from_brep, to_brep
+
+# ================== MESH EXPORT ==================
+# Each solid is tessellated independently (in parallel) into NumPy vertex and triangle buffers, which are then written
+# as binary STL or 3MF without going through the (slower) OCCT writers.
+
+
+@dataclass(frozen=True)
+class Quality:
+    linear: float
+    """Maximum distance between the mesh and the surface (mm)"""
+    angular: float
+    """Maximum angle between adjacent triangles of a curved surface (radians)"""
+
+
+QUALITY_PRESETS = {
+    "draft": Quality(0.1, 0.5),  # Fast previews
+    "print": Quality(0.02, 0.2),  # Below the resolution of FDM printers
+    "fine": Quality(0.005, 0.1),
+}
+
+Mesh = tuple[np.ndarray, np.ndarray]
+"""Vertices (N x 3 float) and triangles (M x 3 vertex indices, counter-clockwise from the outside)"""
+
+
+def triangulate(shape: Shape, quality: Quality = QUALITY_PRESETS["print"]):
+    """Stores a triangulation of the given quality in the faces of the shape"""
+    params = IMeshTools_Parameters()
+    params.Deflection = quality.linear
+    params.Angle = quality.angular
+    params.InParallel = kernel.parallel()
+    params.AllowQualityDecrease = True  # Replace finer meshes from previous exports
+    BRepMesh_IncrementalMesh(shape.wrapped, params)
+
+
+def tessellate(shape: Shape, quality: Quality = QUALITY_PRESETS["print"]) -> Mesh:
+    """Meshes the faces of the shape, merging the vertices shared by adjacent faces"""
+    triangulate(shape, quality)
+    vertices, triangles, offset = [], [], 0
+    explorer = TopExp_Explorer(shape.wrapped, TopAbs_FACE)
+    while explorer.More():
+        face = TopoDS.Face_s(explorer.Current())
+        explorer.Next()
+        loc = TopLoc_Location()
+        poly = BRep_Tool.Triangulation_s(face, loc)
+        if poly is None:
+            continue
+        trsf = loc.Transformation()
+        nodes = np.empty((poly.NbNodes(), 3))
+        for i in range(poly.NbNodes()):
+            nodes[i] = poly.Node(i + 1).Transformed(trsf).Coord()
+        tris = np.array([poly.Triangle(i + 1).Get() for i in range(poly.NbTriangles())], dtype=np.int64) - 1
+        if face.Orientation() == TopAbs_REVERSED:
+            tris = tris[:, ::-1]
+        vertices.append(nodes)
+        triangles.append(tris + offset)
+        offset += len(nodes)
+    if not vertices:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+    return merge_vertices(np.concatenate(vertices), np.concatenate(triangles))
+
+
+def merge_vertices(vertices: np.ndarray, triangles: np.ndarray) -> Mesh:
+    """Merges duplicated vertices (e.g. on the edges between faces), so that the mesh is closed"""
+    vertices, inverse = np.unique(np.round(vertices, 9), axis=0, return_inverse=True)
+    triangles = inverse.reshape(-1)[triangles]
+    degenerate = (triangles[:, 0] == triangles[:, 1]) | (triangles[:, 1] == triangles[:, 2]) | \
+        (triangles[:, 0] == triangles[:, 2])
+    return vertices, triangles[~degenerate]
+
+
+def _tessellate_brep(data: bytes, quality: Quality) -> Mesh:
+    return tessellate(from_brep(data)[0], quality)
+
+
+def tessellate_solids(shape: Shape, quality: Quality = QUALITY_PRESETS["print"],
+                      max_workers: Optional[int] = None) -> list[Mesh]:
+    """One mesh per solid of the shape, tessellated in parallel (unless max_workers is 1)"""
+    return tessellate_all(shape.solids(), quality, max_workers)
+
+
+def tessellate_all(solids: list[Shape], quality: Quality = QUALITY_PRESETS["print"],
+                   max_workers: Optional[int] = None) -> list[Mesh]:
+    """One mesh per solid, tessellated in parallel (unless max_workers is 1)"""
+    if max_workers == 1 or len(solids) <= 1:
+        return [tessellate(solid, quality) for solid in solids]
+    with ProcessPoolExecutor(max_workers) as pool:
+        return list(pool.map(_tessellate_brep, [to_brep([solid]) for solid in solids], [quality] * len(solids)))
+
+
+def merge(meshes: list[Mesh]) -> Mesh:
+    offsets = np.cumsum([0] + [len(vertices) for vertices, _ in meshes[:-1]])
+    return (np.concatenate([vertices for vertices, _ in meshes]),
+            np.concatenate([triangles + offset for (_, triangles), offset in zip(meshes, offsets)]))
+
+
+def write_stl(path: Path, mesh: Mesh):
+    """Binary STL"""
+    vertices, triangles = mesh
+    corners = vertices[triangles].astype(np.float32)  # M x 3 x 3
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    record = np.dtype([("normal", "<f4", 3), ("corners", "<f4", (3, 3)), ("attributes", "<u2")])
+    data = np.zeros(len(triangles), dtype=record)
+    data["normal"] = normals
+    data["corners"] = corners
+    with open(path, "wb") as f:
+        f.write(b"bike_stem_mount".ljust(80, b" "))
+        f.write(np.uint32(len(triangles)).tobytes())
+        f.write(data.tobytes())
+
+
+def read_stl(path: Path) -> Mesh:
+    """Binary or ASCII STL, with the vertices shared by adjacent triangles merged"""
+    data = Path(path).read_bytes()
+    count = int(np.frombuffer(data, "<u4", 1, 80)[0]) if len(data) >= 84 else -1
+    if len(data) == 84 + 50 * count:
+        record = np.dtype([("normal", "<f4", 3), ("corners", "<f4", (3, 3)), ("attributes", "<u2")])
+        corners = np.frombuffer(data, record, count, 84)["corners"].astype(np.float64)
+    else:
+        corners = np.array([line.split()[1:4] for line in data.decode("ascii", "replace").splitlines()
+                            if line.lstrip().startswith("vertex")], dtype=np.float64).reshape(-1, 3, 3)
+    return merge_vertices(corners.reshape(-1, 3), np.arange(len(corners) * 3).reshape(-1, 3))
+
+
+def write_3mf(path: Path, meshes: list[Mesh], names: Optional[list[str]] = None,
+              colors: Optional[list[str]] = None, triangle_colors: Optional[list[np.ndarray]] = None):
+    """3MF with one object per mesh, all placed in the build plate as they are. Triangles can be colored with indices
+    (one array per mesh) of the given "#RRGGBB" colors"""
+    names = names or ["solid-%d" % i for i in range(len(meshes))]
+    model = io.StringIO()
+    model.write('<?xml version="1.0" encoding="UTF-8"?>\n<model unit="millimeter" xml:lang="en-US" '
+                'xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n<resources>\n')
+    if colors:
+        model.write('<basematerials id="%d">\n' % (len(meshes) + 1))
+        for i, color in enumerate(colors):
+            model.write('<base name="color-%d" displaycolor="%s"/>\n' % (i, color))
+        model.write('</basematerials>\n')
+    for i, ((vertices, triangles), name) in enumerate(zip(meshes, names)):
+        material = ' pid="%d" pindex="0"' % (len(meshes) + 1) if colors else ""
+        model.write('<object id="%d" type="model" name="%s"%s><mesh><vertices>\n' % (i + 1, name, material))
+        np.savetxt(model, vertices, fmt='<vertex x="%.6f" y="%.6f" z="%.6f"/>')
+        model.write('</vertices><triangles>\n')
+        if colors:
+            np.savetxt(model, np.column_stack([triangles, triangle_colors[i]]),
+                       fmt='<triangle v1="%%d" v2="%%d" v3="%%d" pid="%d" p1="%%d"/>' % (len(meshes) + 1))
+        else:
+            np.savetxt(model, triangles, fmt='<triangle v1="%d" v2="%d" v3="%d"/>')
+        model.write('</triangles></mesh></object>\n')
+    model.write('</resources>\n<build>\n')
+    for i in range(len(meshes)):
+        model.write('<item objectid="%d"/>\n' % (i + 1))
+    model.write('</build>\n</model>\n')
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as f:
+        def writestr(name: str, data: str):  # With a fixed date, so that the same meshes give the same file
+            f.writestr(zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0)), data, zipfile.ZIP_DEFLATED)
+        writestr("[Content_Types].xml",
+                   '<?xml version="1.0" encoding="UTF-8"?>\n<Types xmlns="http://schemas.openxmlformats.org/'
+                   'package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.'
+                   'openxmlformats-package.relationships+xml"/><Default Extension="model" ContentType="application/'
+                   'vnd.ms-package.3dmanufacturing-3dmodel+xml"/></Types>')
+        writestr("_rels/.rels",
+                   '<?xml version="1.0" encoding="UTF-8"?>\n<Relationships xmlns="http://schemas.openxmlformats.org/'
+                   'package/2006/relationships"><Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://'
+                   'schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/></Relationships>')
+        writestr("3D/3dmodel.model", model.getvalue())
+
+
+def write_amf(path: Path, meshes: list[Mesh], names: Optional[list[str]] = None):
+    """AMF with one object per mesh"""
+    names = names or ["solid-%d" % i for i in range(len(meshes))]
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<amf unit="millimeter" version="1.1">\n')
+        for i, ((vertices, triangles), name) in enumerate(zip(meshes, names)):
+            f.write('<object id="%d"><metadata type="name">%s</metadata><mesh><vertices>\n' % (i, name))
+            np.savetxt(f, vertices, fmt="<vertex><coordinates><x>%.6f</x><y>%.6f</y><z>%.6f</z></coordinates></vertex>")
+            f.write('</vertices><volume>\n')
+            np.savetxt(f, triangles, fmt="<triangle><v1>%d</v1><v2>%d</v2><v3>%d</v3></triangle>")
+            f.write('</volume></mesh></object>\n')
+        f.write('</amf>\n')
+
+
+def write_glb(path: Path, meshes: list[Mesh], names: Optional[list[str]] = None):
+    """Binary glTF with one node per mesh, under a root node converting millimeters (Z up) to meters (Y up)"""
+    names = names or ["solid-%d" % i for i in range(len(meshes))]
+    buffer, views, accessors, gltf_meshes = io.BytesIO(), [], [], []
+    for vertices, triangles in meshes:
+        positions = vertices.astype("<f4").reshape(-1, 3)
+        bounds = (positions.min(axis=0), positions.max(axis=0)) if len(positions) else (np.zeros(3), np.zeros(3))
+        for data, target, accessor in (
+                (positions, 34962, {"componentType": 5126, "type": "VEC3", "count": len(positions),
+                                    "min": bounds[0].tolist(), "max": bounds[1].tolist()}),
+                (triangles.astype("<u4"), 34963, {"componentType": 5125, "type": "SCALAR", "count": triangles.size})):
+            views.append({"buffer": 0, "byteOffset": buffer.tell(), "byteLength": data.nbytes, "target": target})
+            accessors.append({"bufferView": len(views) - 1, **accessor})
+            buffer.write(data.tobytes())  # Both 4-byte aligned
+        gltf_meshes.append({"primitives": [{"attributes": {"POSITION": len(accessors) - 2},
+                                            "indices": len(accessors) - 1}]})
+    document = {
+        "asset": {"version": "2.0", "generator": "bike_stem_mount"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"name": "root", "children": list(range(1, len(meshes) + 1)), "scale": [0.001] * 3,
+                   "rotation": [-0.5 ** 0.5, 0, 0, 0.5 ** 0.5]}] +
+                 [{"name": name, "mesh": i} for i, name in enumerate(names)],
+        "meshes": gltf_meshes,
+        "accessors": accessors,
+        "bufferViews": views,
+        "buffers": [{"byteLength": buffer.tell()}],
+    }
+    header = json.dumps(document, separators=(",", ":")).encode()
+    header += b" " * (-len(header) % 4)
+    binary = buffer.getvalue()
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sII", b"glTF", 2, 12 + 8 + len(header) + 8 + len(binary)))
+        f.write(struct.pack("<I4s", len(header), b"JSON") + header)
+        f.write(struct.pack("<I4s", len(binary), b"BIN\0") + binary)
+
+
+def piece_sizes(shape: Shape) -> list[int]:
+    """Number of solids of each printable piece: the children of an (unfused) assembly, or each solid otherwise"""
+    children = list(shape) if isinstance(shape, Compound) else []
+    if children and all(isinstance(child, Compound) for child in children):
+        return [len(child.solids()) for child in children]
+    return [1] * len(shape.solids())
+
+
+def piece_meshes(shape: Shape, quality: Quality = QUALITY_PRESETS["print"],
+                 max_workers: Optional[int] = None) -> list[Mesh]:
+    """One mesh per printable piece, merging the (overlapping) solids of a piece, as slicers will join them"""
+    solid_meshes = tessellate_solids(shape, quality, max_workers)
+    meshes, start = [], 0
+    for size in piece_sizes(shape):
+        meshes.append(merge(solid_meshes[start:start + size]))
+        start += size
+    return meshes
+
+
+def export_mesh(shape: Shape, path: Path, quality: str = "print", per_solid: bool = False,
+                max_workers: Optional[int] = None) -> list[Path]:
+    """Exports the shape as a STL or 3MF (by extension) mesh, or one file per printable solid, returning the written
+    files"""
+    path = Path(path)
+    if path.suffix.lower() not in (".stl", ".3mf"):
+        raise ValueError("Unsupported mesh format %r (expected .stl or .3mf)" % path.suffix)
+    meshes = piece_meshes(shape, QUALITY_PRESETS[quality], max_workers)
+    if per_solid:
+        paths = [path.with_name("%s-%d%s" % (path.stem, i, path.suffix)) for i in range(len(meshes))]
+        for mesh, solid_path in zip(meshes, paths):
+            export_mesh_file(solid_path, [mesh])
+        return paths
+    export_mesh_file(path, meshes)
+    return [path]
+
+
+def export_mesh_file(path: Path, meshes: list[Mesh]):
+    if Path(path).suffix.lower() == ".3mf":
+        write_3mf(path, meshes)
+    else:
+        write_stl(path, merge(meshes))
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Exports the assembly as STL or 3MF meshes")
+    parser.add_argument("output", type=Path, nargs="?", default=Path("bike-stem-mount.stl"))
+    parser.add_argument("--quality", choices=list(QUALITY_PRESETS), default="print")
+    parser.add_argument("--per-solid", action="store_true", help="Write one file per printable solid")
+    parser.add_argument("--workers", type=int, default=None)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        config = from_args(args)  # Fail before building anything
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+    from bike_stem_mount.snapshot import assembly
+    for file in export_mesh(assembly(config), args.output, args.quality, args.per_solid, args.workers):
+        print("Exported %s" % file)
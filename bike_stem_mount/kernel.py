@@ -0,0 +1,131 @@
+# %%
+import contextlib
+import os
+from typing import Any, Iterator
+import build123d.topology.composite
+import build123d.topology.one_d
+import build123d.topology.shape_core
+from OCP.BOPAlgo import BOPAlgo_GlueEnum, BOPAlgo_Options
+from OCP.BRepAlgoAPI import BRepAlgoAPI_Common, BRepAlgoAPI_Cut, BRepAlgoAPI_Fuse, BRepAlgoAPI_Splitter
+from OCP.BRepCheck import BRepCheck_Analyzer
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+from bike_stem_mount.parts import global_params
+
+# ================== GEOMETRY KERNEL ==================
+# OCCT settings, from the kernel_* global parameters: parallel mode (of booleans, checks and meshing), and a fuzzy value
+# and glue option per class of boolean. build123d creates its OCCT algorithms itself, so install() replaces the classes
+# it uses with subclasses applying the settings when created. Options given explicitly (e.g. fuse(tol=...)) still take
+# precedence, and build123d asking for parallel mode only gets it if kernel_parallel is set.
+#
+# OCCT's thread pool doesn't survive a fork: a forked process using it after its parent did hangs. So processes forked
+# after parallel mode was used (e.g. the workers of build_graph.py) run everything serially, and robust.py spawns its
+# worker process instead.
+#
+# The build entry points (the build functions of the parts, build_assembly(), validate_part()...) call install(), and
+# the settings are read from the global parameters each time an algorithm is created.
+
+OPERATIONS = {"fuse": BRepAlgoAPI_Fuse, "cut": BRepAlgoAPI_Cut, "intersect": BRepAlgoAPI_Common,
+              "split": BRepAlgoAPI_Splitter}
+"""OCCT class of each class of boolean"""
+
+# The process state survives reloading this module (e.g. by watch.py), as the thread pool does
+_threads_used = globals().get("_threads_used", False)
+"""Whether this process may have started OCCT's thread pool"""
+_serial = globals().get("_serial", False)
+"""Forked after the thread pool was started"""
+_overrides: dict[str, Any] = {}
+"""Settings replacing the global parameters, see overridden()"""
+
+
+def _setting(name: str) -> Any:
+    return _overrides[name] if name in _overrides else getattr(global_params, name, None)
+
+
+def parallel() -> bool:
+    """Whether an OCCT algorithm created now should run in parallel mode"""
+    global _threads_used
+    if not _setting("kernel_parallel") or _serial:
+        return False
+    _threads_used = True
+    return True
+
+
+def settings() -> dict[str, Any]:
+    """The current kernel settings (from the global parameters)"""
+    return {name: _setting(name) for name in vars(global_params) if name.startswith("kernel_")}
+
+
+@contextlib.contextmanager
+def overridden(**settings: Any) -> Iterator[None]:
+    """Creates the algorithms within it with these settings (e.g. kernel_fuzzy_cut=1e-3) instead of the global
+    parameters"""
+    previous = dict(_overrides)
+    _overrides.update(settings)
+    try:
+        yield
+    finally:
+        _overrides.clear()
+        _overrides.update(previous)
+
+
+def _boolean(name: str, base: type) -> type:
+    class Configured(base):
+        def __init__(self, *args):
+            super().__init__(*args)
+            super().SetRunParallel(parallel())
+            fuzzy = _setting("kernel_fuzzy_" + name)
+            if fuzzy:
+                self.SetFuzzyValue(fuzzy)
+            if _setting("kernel_glue_" + name):
+                self.SetGlue(BOPAlgo_GlueEnum.BOPAlgo_GlueShift)
+
+        def SetRunParallel(self, run_parallel: bool):
+            super().SetRunParallel(run_parallel and parallel())
+    Configured.__name__ = Configured.__qualname__ = base.__name__
+    return Configured
+
+
+class _Analyzer(BRepCheck_Analyzer):
+    def SetParallel(self, run_parallel: bool):
+        super().SetParallel(run_parallel and parallel())
+
+
+class _Mesh(BRepMesh_IncrementalMesh):
+    def __init__(self, *args):
+        if len(args) == 5:  # Shape, deflection, relative, angle and in parallel
+            args = args[:4] + (args[4] and parallel(),)
+        super().__init__(*args)
+
+
+CONFIGURED = {name: _boolean(name, base) for name, base in OPERATIONS.items()}
+"""Subclass of each OCCT boolean class, applying the settings"""
+_PATCHES = [
+    (build123d.topology.shape_core, "BRepAlgoAPI_Fuse", CONFIGURED["fuse"]),
+    (build123d.topology.shape_core, "BRepAlgoAPI_Cut", CONFIGURED["cut"]),
+    (build123d.topology.shape_core, "BRepAlgoAPI_Common", CONFIGURED["intersect"]),
+    (build123d.topology.composite, "BRepAlgoAPI_Fuse", CONFIGURED["fuse"]),
+    (build123d.topology.one_d, "BRepAlgoAPI_Splitter", CONFIGURED["split"]),
+    (build123d.topology.shape_core, "BRepCheck_Analyzer", _Analyzer),
+    (build123d.topology.shape_core, "BRepMesh_IncrementalMesh", _Mesh),
+]
+"""build123d modules creating the algorithms, with the class to create"""
+
+
+def install():
+    """Makes build123d create its OCCT algorithms with the current settings, and sets the parallel mode of the other
+    booleans (e.g. of validate.py). Call it again after changing kernel_parallel."""
+    for module, name, cls in _PATCHES:
+        setattr(module, name, cls)
+    BOPAlgo_Options.SetParallelMode_s(bool(global_params.kernel_parallel) and not _serial)
+
+
+def _after_fork():
+    global _serial
+    if _threads_used:
+        _serial = True
+        BOPAlgo_Options.SetParallelMode_s(False)
+
+
+if not globals().get("_fork_hook"):  # Once per process, even if reloaded (the hook calls the current _after_fork)
+    os.register_at_fork(after_in_child=lambda: _after_fork())
+    _fork_hook = True
@@ -1,24 +1,127 @@
 # %%
-from bike_stem_mount.parts.headset_screw import headset_screw_part
-from bike_stem_mount.parts.stem import stem_part
-from bike_stem_mount.parts.handle_bars import handle_bars_part
+from bike_stem_mount.parts.headset_screw import HeadsetScrewParams, build_headset_screw, headset_screw_key, \
+    p as headset_p
+from bike_stem_mount.parts.stem import StemParams, build_stem, stem_key, p as stem_p
+from bike_stem_mount.parts.handle_bars import HandleBarParams, build_handle_bars, handle_bars_key, \
+    p as handle_bars_p
 from bike_stem_mount.parts.global_params import *
+from bike_stem_mount.build_graph import assembly_nodes, run
+from bike_stem_mount.cache import part_cache
+from bike_stem_mount import kernel, robust
+from bike_stem_mount.validate import boxes_overlap
+from typing import Optional
 from build123d import *
+from OCP.BRepClass3d import BRepClass3d_SolidClassifier
+from OCP.TopAbs import TopAbs_IN, TopAbs_ON
 
 # ================== MODELLING (ASSEMBLY) ==================
 
-with BuildPart() as assembly:
-    add(headset_screw_part)
-    add(stem_part)
-assembly = assembly.part.fuse(handle_bars_part)  # HACK: Avoids crash ¯\_(ツ)_/¯
-del headset_screw_part
-del stem_part
-del handle_bars_part
 
-if len(assembly.solids()) != 4:
-    print("Warning: Expected 4 solids, got %d" % len(assembly.solids()))
+def _touches(a: Solid, b: Solid, b_box: BoundBox) -> bool:
+    """Whether any vertex or edge midpoint of a is inside or on b (much cheaper than an exact distance)"""
+    classifier = BRepClass3d_SolidClassifier(b.wrapped)
+    for point in [vertex.center() for vertex in a.vertices()] + [edge @ 0.5 for edge in a.edges()]:
+        if all(b_box.min.to_tuple()[i] - eps <= point.to_tuple()[i] <= b_box.max.to_tuple()[i] + eps
+               for i in range(3)):
+            classifier.Perform(point.to_pnt(), eps)
+            if classifier.State() in (TopAbs_IN, TopAbs_ON):
+                return True
+    return False
+
+
+def printable_pieces(solids: list[Solid]) -> list[list[Solid]]:
+    """Groups the solids that overlap or touch each other (and will print as one piece)"""
+    boxes = [solid.bounding_box() for solid in solids]
+    groups = list(range(len(solids)))
+
+    def group(i: int) -> int:
+        while groups[i] != i:
+            i = groups[i]
+        return i
+
+    for i in range(len(solids)):
+        for j in range(i + 1, len(solids)):
+            if group(i) != group(j) and boxes_overlap(boxes[i], boxes[j], eps) and (
+                    _touches(solids[i], solids[j], boxes[j]) or _touches(solids[j], solids[i], boxes[i])):
+                groups[group(j)] = group(i)
+    pieces = {}
+    for i, solid in enumerate(solids):
+        pieces.setdefault(group(i), []).append(solid)
+    return list(pieces.values())
+
+
+def assembly_key(headset_p: HeadsetScrewParams = headset_p, stem_p: StemParams = stem_p,
+                 handle_bars_p: HandleBarParams = handle_bars_p) -> str:
+    """Cache key of the (unfused) assembly, e.g. for renders or validation results"""
+    return part_cache.key("assembly", headset_screw_key(headset_p), stem_key(stem_p, headset_p),
+                          handle_bars_key(handle_bars_p, stem_p, headset_p), module=__name__)
+
+
+def build_assembly(headset_p: HeadsetScrewParams = headset_p, stem_p: StemParams = stem_p,
+                   handle_bars_p: HandleBarParams = handle_bars_p, workers: Optional[int] = None,
+                   fuse: bool = False) -> Compound:
+    """Builds the parts in parallel (unless workers is 1) and combines them into a compound with one child per
+    printable piece. The (expensive) fusion of the solids of each piece only happens if requested, and the pieces are
+    checked by validate.py."""
+    kernel.install()
+    if workers != 1:
+        run(assembly_nodes(headset_p, stem_p, handle_bars_p), workers)
+    headset_screw_part = build_headset_screw(headset_p)
+    stem_part, _ = build_stem(stem_p, headset_p)
+    handle_bars_part = build_handle_bars(handle_bars_p, stem_p, headset_p)
+    pieces = printable_pieces(headset_screw_part.solids() + stem_part.solids() + handle_bars_part.solids())
+    del headset_screw_part
+    del stem_part
+    del handle_bars_part
+
+    if fuse:
+        return Compound([robust.fuse(piece[0], *piece[1:], solids=1, label="piece %d" % i).clean() if len(piece) > 1
+                         else piece[0] for i, piece in enumerate(pieces)])
+    return Compound([Compound(piece) for piece in pieces])
+
+
+def __getattr__(name: str):
+    if name == "assembly":  # Lazily built on first access
+        return build_assembly()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ != "__main__" and "show_object" in globals():
+    # Executed by CQ-editor or cq-cli (e.g. by the cadquery-action of the CI workflow), which don't run it as
+    # __main__ and only see the shapes bound at module level and passed to show_object()
+    assembly = build_assembly()
+    show_object(assembly, "bike-stem-mount")  # type: ignore
+
 
 if __name__ == "__main__":
+    import argparse
+    from pathlib import Path
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Builds, checks and shows (or exports) the assembly")
+    parser.add_argument("--export", metavar="FORMATS",
+                        help="Export the assembly and the parts in these formats (e.g. stl,step,3mf) to --out, with a "
+                             "manifest (see artifacts.py), instead of the fallback bike-stem-mount.stl")
+    parser.add_argument("--out", default="artifacts", type=Path, help="Output directory of --export")
+    parser.add_argument("--memory", action="store_true",
+                        help="Build in this process and print the time and peak memory of each modelling stage")
+    add_arguments(parser)
+    args = parser.parse_known_args()[0]  # Ignores the arguments of interactive kernels
+    try:
+        config = from_args(args)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+    params = config.params()
+    if args.memory:
+        from bike_stem_mount.cache import scoped_build
+        robust.settings.timeout = None  # The robust.py operations in this process too, to measure them
+        with scoped_build() as scope:
+            assembly = build_assembly(**params, workers=1)
+        print(scope.report())
+    else:
+        assembly = build_assembly(**params)
+    from bike_stem_mount.validate import validate
+    for issue in validate(**params):
+        print("Warning: %s" % issue)
     try:
         import ocp_vscode
         ocp_vscode.show_all(measure_tools=True, render_joints=True)
@@ -31,6 +134,11 @@ if __name__ == "__main__":
 
 if __name__ == "__main__":
     export = True
+    if args.export:
+        from bike_stem_mount.artifacts import export_artifacts
+        manifest = export_artifacts(args.export.lower().split(","), args.out, config=config)
+        print("Exported %d files to %s" % (len(manifest["files"]), args.out))
+        export = False
     try:
         if "show_object" in locals():
             show_object(assembly, "bike-stem-mount")  # type: ignore
@@ -43,6 +151,7 @@ if __name__ == "__main__":
 
     if export:
         print("Exporting to STL")
-        assembly.export_stl("bike-stem-mount.stl")
+        from bike_stem_mount.export import export_mesh
+        export_mesh(assembly, "bike-stem-mount.stl")
 
 # %%
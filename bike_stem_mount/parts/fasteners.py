@@ -0,0 +1,61 @@
+# %%
+from dataclasses import dataclass
+
+# ================== FASTENERS ==================
+# Dimensions of the screws and nuts held by the screwable cylinders, by ISO size, head type and nut type. The table is
+# plain data (no build123d), so that parameters naming a fastener can be checked quickly: the pockets of each fastener
+# are built once per size and tolerance by screwable_cylinder.fastener_cutter().
+
+
+@dataclass(frozen=True)
+class Fastener:
+    size: str
+    """ISO metric size, e.g. "M5" """
+    head: str
+    nut: str
+    screw_diameter: float
+    head_diameter: float
+    """Of the round pocket of the head (across corners for hex heads)"""
+    head_height: float
+    nut_width: float
+    """Across flats"""
+    nut_height: float
+
+    @property
+    def name(self) -> str:
+        return "%s-%s-%s" % (self.size, self.head, self.nut)
+
+
+SIZES = {"M3": 3, "M4": 4, "M5": 5, "M6": 6}
+"""Screw diameter of each size"""
+HEADS = {  # (Diameter, height) by size
+    "socket": {"M3": (5.5, 3), "M4": (7, 4), "M5": (8.5, 5), "M6": (10, 6)},  # ISO 4762
+    "button": {"M3": (5.7, 1.65), "M4": (7.6, 2.2), "M5": (9.5, 2.75), "M6": (10.5, 3.3)},  # ISO 7380
+    "hex": {"M3": (6.01, 2), "M4": (7.66, 2.8), "M5": (8.79, 3.5), "M6": (11.05, 4)},  # ISO 4017
+}
+NUTS = {  # (Width across flats, height) by size
+    "hex": {"M3": (5.5, 2.4), "M4": (7, 3.2), "M5": (8, 4.7), "M6": (10, 5.2)},  # ISO 4032
+    "thin": {"M3": (5.5, 1.8), "M4": (7, 2.2), "M5": (8, 2.7), "M6": (10, 3.2)},  # ISO 4035
+    "nyloc": {"M3": (5.5, 4), "M4": (7, 5), "M5": (8, 5), "M6": (10, 6)},  # DIN 985
+}
+DEFAULT_HEAD = "socket"
+DEFAULT_NUT = "hex"
+
+FASTENERS = {fastener.name: fastener for fastener in (
+    Fastener(size, head, nut, diameter, *HEADS[head][size], *NUTS[nut][size])
+    for size, diameter in SIZES.items() for head in HEADS for nut in NUTS)}
+"""Index of every combination by name, e.g. "M5-socket-hex" """
+
+
+def lookup(name: str) -> Fastener:
+    """The fastener of a "<size>[-<head>[-<nut>]]" name (with the default head and nut if omitted), e.g. "M4" or
+    "M3-button-thin", or ValueError"""
+    parts = name.strip().split("-")
+    fastener = None
+    if len(parts) <= 3:
+        size, head, nut = parts + [DEFAULT_HEAD, DEFAULT_NUT][len(parts) - 1:]
+        fastener = FASTENERS.get("%s-%s-%s" % (size.upper(), head.lower(), nut.lower()))
+    if fastener is None:
+        raise ValueError("Unknown fastener %r (expected <size>[-<head>[-<nut>]] with sizes %s, heads %s and nuts %s)"
+                         % (name, ", ".join(SIZES), ", ".join(HEADS), ", ".join(NUTS)))
+    return fastener
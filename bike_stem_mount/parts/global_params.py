@@ -1,4 +1,4 @@
-from build123d import MM
+MM = 1  # build123d's unit, without importing it (so that the parameters can be read without the kernel)
 
 # ================== GLOBAL PARAMETERS ==================
 # 3D printing basics
@@ -7,3 +7,12 @@ wall_min = 0.4 * MM  # Minimum wall width
 wall = wall_min * 3 * MM  # Recommended width for most walls of this print
 eps = 1e-5 * MM  # A small number
 screw_floating_cut = 2 * MM  # How much free space between screw-connected parts
+
+# Geometry kernel (OCCT) settings of the booleans, see kernel.py
+kernel_parallel = True  # Run booleans (including splits) in OCCT's parallel mode, using all cores
+kernel_fuzzy_fuse = 0 * MM  # Fuzzy value of each class of booleans (0: exact), unless given explicitly
+kernel_fuzzy_cut = 0 * MM
+kernel_fuzzy_intersect = 0 * MM
+kernel_fuzzy_split = 0 * MM
+kernel_glue_fuse = False  # Glue option (faster, but only valid if the shapes don't overlap, just share faces)
+kernel_glue_cut = False
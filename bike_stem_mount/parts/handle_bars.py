@@ -2,8 +2,12 @@
 from dataclasses import dataclass
 from build123d import *
 from bike_stem_mount.parts.global_params import *
-from bike_stem_mount.parts.stem import stem_height, stem_side_faces
-from bike_stem_mount.parts.screwable_cylinder import ScrewableCylinder
+from typing import Optional
+from bike_stem_mount.parts.headset_screw import HeadsetScrewParams, p as headset_p
+from bike_stem_mount.parts.stem import StemParams, build_stem, stem_key, compute_stem_height, p as stem_p
+from bike_stem_mount.parts.screwable_cylinder import build_screwable_cylinder, instance, screwable_cylinder_key
+from bike_stem_mount.cache import part_cache, shapes_key, stage_cache
+from bike_stem_mount import kernel, robust
 
 # ================== PARAMETERS ==================
 
@@ -14,8 +18,8 @@ class HandleBarParams:
     height: float = wall
     rotation: float = 5
     radius: float = 16
-    offset_x_center: float = stem_side_faces.group_by(
-        Axis.Y)[-1].vertices().group_by(Axis.X)[-1].vertex().X + 3 + radius
+    offset_x_center: Optional[float] = None
+    """Defaults to just outside the stem side faces"""
     offset_y_start: float = 25
 
 
@@ -23,115 +27,176 @@ p = HandleBarParams()
 
 # ================== MODELLING ==================
 
-handlebar_side_loc = Location(
-    (p.offset_x_center, p.offset_y_start, stem_height), (0, 90, 90))
-with BuildSketch(handlebar_side_loc) as handlebar_side:
-    Rectangle(p.width, p.height,
-              align=Align.MIN, rotation=-p.rotation)
-with BuildPart() as handlebar_side_conn:
-    face = stem_side_faces.group_by(Axis.Y)[-1].face()
+
+screwable_cylinder_kwargs = dict(rotation=(0, 180, 0))
+
+
+def _build(p: HandleBarParams, stem_p: StemParams, stem_side_faces: ShapeList[Face], screwable_cylinder: Part) -> Part:
+    # Each stage only reads the parameters it declares and the values of the stages it depends on (see stage_cache)
+    stem_height = compute_stem_height(stem_p)
+    offset_x_center = p.offset_x_center
+    if offset_x_center is None:
+        offset_x_center = stem_side_faces.group_by(
+            Axis.Y)[-1].vertices().group_by(Axis.X)[-1].vertex().X + 3 + p.radius
+
+    def side_conn():
+        handlebar_side_loc = Location(
+            (offset_x_center, p.offset_y_start, stem_height), (0, 90, 90))
+        with BuildSketch(handlebar_side_loc) as handlebar_side:
+            Rectangle(p.width, p.height,
+                      align=Align.MIN, rotation=-p.rotation)
+        with BuildPart() as handlebar_side_conn:
+            face = stem_side_faces.group_by(Axis.Y)[-1].face()
+            face_loc = Location(face.edges().group_by(
+                SortBy.LENGTH)[-1].group_by(Axis.Z)[0].edge()@1)
+            with BuildLine() as handlebar_side_conn_path:
+                Spline(face_loc.position,
+                       handlebar_side_loc.position,
+                       tangents=[(0, 1, 0), Vector(1, 0, 0).normalized()],
+                       tangent_scalars=[.5, 1])
+            thin_factor = 3
+            sweep(sections=[handlebar_side.sketch, handlebar_side.sketch.moved(Location((-thin_factor, 0, 0))), face],
+                  path=handlebar_side_conn_path, multisection=True)
+            del handlebar_side
+            del face
+            del face_loc
+            del handlebar_side_conn_path
+        handlebar_side_conn = handlebar_side_conn.part
+        del handlebar_side_loc
+
+        # Nice and clean filleting
+        to_fillet = handlebar_side_conn.faces().group_by(Axis.Y)[1].edges()
+        to_fillet += handlebar_side_conn.faces().group_by(Axis.Y)[-1].edges()
+        to_fillet -= to_fillet.group_by(SortBy.LENGTH)[0]
+        return robust.fillet(handlebar_side_conn, wall/2.05, to_fillet, solids=1, label="handle_bars.side_conn")
+    side_conn = stage_cache.run("handle_bars.side_conn", side_conn,
+                                (offset_x_center, p.offset_y_start, p.width, p.height, p.rotation, wall),
+                                deps=(shapes_key(stem_side_faces),))  # Not the stem key: e.g. its fillets don't matter
     del stem_side_faces
-    face_loc = Location(face.edges().group_by(
-        SortBy.LENGTH)[-1].group_by(Axis.Z)[0].edge()@1)
-    with BuildLine() as handlebar_side_conn_path:
-        Spline(face_loc.position,
-               handlebar_side_loc.position,
-               tangents=[(0, 1, 0), Vector(1, 0, 0).normalized()],
-               tangent_scalars=[.5, 1])
-    thin_factor = 3
-    sweep(sections=[handlebar_side.sketch, handlebar_side.sketch.moved(Location((-thin_factor, 0, 0))), face],
-          path=handlebar_side_conn_path, multisection=True)
-    del handlebar_side
-    del face
-    del face_loc
-    del handlebar_side_conn_path
-handlebar_side_conn = handlebar_side_conn.part
-
-# Nice and clean filleting
-to_fillet = handlebar_side_conn.faces().group_by(Axis.Y)[1].edges()
-to_fillet += handlebar_side_conn.faces().group_by(Axis.Y)[-1].edges()
-to_fillet -= to_fillet.group_by(SortBy.LENGTH)[0]
-handlebar_side_conn = handlebar_side_conn.fillet(
-    radius=wall/2.05, edge_list=to_fillet)
-
-handle_bar_top_loc = handlebar_side_conn.faces().group_by(
-    Axis.X)[-1].face().center_location
-with BuildPart() as handle_bar_core:
-    with BuildSketch(handle_bar_top_loc):
-        RectangleRounded(p.height, p.width, p.height/2.01,
-                         rotation=-p.rotation)
-    revolve(axis=Axis(handle_bar_top_loc.position - (0, 0, p.radius +
-                                                     p.height/2), (0, 1, 0)))
-handle_bar_core = handle_bar_core.part
-
-# Make adapter for screwable cylinder to connect to the ring
-screwable_cylinder = ScrewableCylinder(rotation=(0, 180, 0))
-bb = screwable_cylinder.bounding_box()
-sc_box = Box(bb.size.X, bb.size.Y, bb.size.Z)
-handle_bar_face_cut = handle_bar_core.faces().group_by(SortBy.AREA)[-1].face()
-hbfc_com = handle_bar_face_cut.center(CenterOf.MASS)
-handle_bar_face_cut = handle_bar_face_cut.moved(
-    Location((-hbfc_com.X + p.radius, -hbfc_com.Y, -hbfc_com.Z))) & sc_box
-# Push it in the X axis to touch the screwable cylinder's bounding box
-handle_bar_face_cut = handle_bar_face_cut.moved(Location(Vector(10, 0, 0)))
-handle_bar_face_cut = handle_bar_face_cut.moved(
-    Location(Vector(-handle_bar_face_cut.face().distance_to(sc_box), 0, 0)))
-sc_face_cut = screwable_cylinder.faces().group_by(
-    SortBy.AREA)[-1].face() & sc_box.moved(Location((bb.size.X/2, 0, 0)))
-screw_part_adapter_add = loft([handle_bar_face_cut, sc_face_cut])
-assert screw_part_adapter_add.is_valid(), "Loft failed"
-# HACK: Loft doesn't match precisely, so we fuse it with extremely high tolerance
-screw_part_adapter = screwable_cylinder.fuse(
-    screw_part_adapter_add, tol=1.0).clean()
-del screwable_cylinder, sc_box, sc_face_cut, screw_part_adapter_add
-to_fillet = screw_part_adapter.faces().group_by(Axis.Z)[-1].edges()
-to_fillet += screw_part_adapter.faces().group_by(Axis.Z)[0].edges()
-to_fillet -= to_fillet.group_by(SortBy.LENGTH)[0]
-to_fillet -= to_fillet.group_by(SortBy.LENGTH)[-1]
-to_fillet -= to_fillet.group_by(Axis.X)[-1]
-screw_part_adapter = screw_part_adapter.fillet(wall-tol, to_fillet)
-del to_fillet
-
-handle_bar_center = handle_bar_core.center()
-
-# Connect the adapter to the handlebar
-spa_bb = screw_part_adapter.bounding_box()
-screw_part_adapter = screw_part_adapter.located(handle_bar_face_cut.location.inverse(
-) * Location((-hbfc_com.X + p.radius, -hbfc_com.Y, -hbfc_com.Z)).inverse())
-del handlebar_side_loc, handle_bar_top_loc, handle_bar_face_cut, hbfc_com
-# HACK: Loft doesn't match precisely, so we fuse it
-handle_bar_core = handle_bar_core.fuse(screw_part_adapter)
-
-# Connect the mirrored adapter, around the center of the handlebar
-screw_part_adapter_mirror = mirror(objects=screw_part_adapter,
-                                   about=Plane(Location(handle_bar_center) * Plane.YZ.location))
-handle_bar_core = handle_bar_core.fuse(screw_part_adapter_mirror)
-del screw_part_adapter, screw_part_adapter_mirror
-assert len(handle_bar_core.solids()) == 1, "Expected 1 solid"
-
-# Add the finished handle bar to the crazy side conn curve
-handlebar_side_conn = handlebar_side_conn.fuse(handle_bar_core)
-assert len(handlebar_side_conn.solids()) == 1, "Expected 1 solid"
-del handle_bar_core
-
-# Cut the handlebar side connector to fit the handlebar
-RigidJoint("split_joint", handlebar_side_conn, Location(
-    handle_bar_center + (0, 0, 1)))  # "Center" of screw hole
-del handle_bar_center
-bb = handlebar_side_conn.bounding_box()
-cutout = Box(bb.size.X + tol, bb.size.Y + tol, screw_floating_cut)
-RigidJoint("center", cutout, Location((0, 0, 0)))
-handlebar_side_conn.joints["split_joint"].connect_to(cutout.joints["center"])
-handlebar_side_conn = handlebar_side_conn.cut(cutout)
-del cutout
-assert len(handlebar_side_conn.solids()) == 2, "Expected 2 solids"
-
-# Join a mirrored version of the handlebar side
-handle_bars_part = handlebar_side_conn
-handle_bars_part = handle_bars_part.fuse(
-    mirror(objects=handlebar_side_conn))
-del handlebar_side_conn
+
+    def core():
+        top_face = side_conn.value.faces().group_by(Axis.X)[-1].face()
+        # Not center_location, whose x direction depends on the parametrization of the face (e.g. whether the stem was
+        # loaded from the part cache), which would turn the handlebar profile
+        handle_bar_top_loc = Plane(top_face.position_at(0.5, 0.5), x_dir=(0, 0, 1),
+                                   z_dir=top_face.normal_at(top_face.position_at(0.5, 0.5))).location
+        del top_face
+        with BuildPart() as handle_bar_core:
+            with BuildSketch(handle_bar_top_loc):
+                RectangleRounded(p.height, p.width, p.height/2.01,
+                                 rotation=-p.rotation)
+            revolve(axis=Axis(handle_bar_top_loc.position - (0, 0, p.radius +
+                                                             p.height/2), (0, 1, 0)))
+        del handle_bar_top_loc
+        return handle_bar_core.part
+    core = stage_cache.run("handle_bars.core", core, (p.height, p.width, p.rotation, p.radius), deps=(side_conn,))
+
+    def adapter():
+        handle_bar_core = core.value
+        # Make adapter for screwable cylinder to connect to the ring
+        bb = screwable_cylinder.bounding_box()
+        sc_box = Box(bb.size.X, bb.size.Y, bb.size.Z)
+        handle_bar_face_cut = handle_bar_core.faces().group_by(SortBy.AREA)[-1].face()
+        hbfc_com = handle_bar_face_cut.center(CenterOf.MASS)
+        handle_bar_face_cut = handle_bar_face_cut.moved(
+            Location((-hbfc_com.X + p.radius, -hbfc_com.Y, -hbfc_com.Z))) & sc_box
+        # Push it in the X axis to touch the screwable cylinder's bounding box
+        handle_bar_face_cut = handle_bar_face_cut.moved(Location(Vector(10, 0, 0)))
+        handle_bar_face_cut = handle_bar_face_cut.moved(
+            Location(Vector(-handle_bar_face_cut.face().distance_to(sc_box), 0, 0)))
+        sc_face_cut = screwable_cylinder.faces().group_by(
+            SortBy.AREA)[-1].face() & sc_box.moved(Location((bb.size.X/2, 0, 0)))
+        screw_part_adapter_add = loft([handle_bar_face_cut, sc_face_cut])
+        # Loft doesn't match precisely, so the fuse needs a high fuzzy tolerance
+        screw_part_adapter = robust.fuse(screwable_cylinder, screw_part_adapter_add, fuzzy=1.0, solids=1,
+                                         label="handle_bars.adapter").clean()
+        del sc_box, sc_face_cut, screw_part_adapter_add
+        to_fillet = screw_part_adapter.faces().group_by(Axis.Z)[-1].edges()
+        to_fillet += screw_part_adapter.faces().group_by(Axis.Z)[0].edges()
+        to_fillet -= to_fillet.group_by(SortBy.LENGTH)[0]
+        to_fillet -= to_fillet.group_by(SortBy.LENGTH)[-1]
+        to_fillet -= to_fillet.group_by(Axis.X)[-1]
+        screw_part_adapter = robust.fillet(screw_part_adapter, wall-tol, to_fillet, solids=1,
+                                           label="handle_bars.adapter")
+        del to_fillet
+
+        # Move the adapter to the handlebar
+        return screw_part_adapter.located(handle_bar_face_cut.location.inverse(
+        ) * Location((-hbfc_com.X + p.radius, -hbfc_com.Y, -hbfc_com.Z)).inverse())
+    adapter = stage_cache.run("handle_bars.adapter", adapter, (p.radius, wall, tol),
+                              deps=(core, screwable_cylinder_key(**screwable_cylinder_kwargs)))
+    del screwable_cylinder
+
+    def join():
+        handle_bar_core = core.value
+        handle_bar_center = handle_bar_core.center()
+
+        # Connect the adapter to the handlebar
+        screw_part_adapter = adapter.value
+        # Loft doesn't match precisely, so fuzzy values are tried if needed
+        handle_bar_core = robust.fuse(handle_bar_core, screw_part_adapter, solids=1, label="handle_bars.join adapter")
+
+        # Connect the mirrored adapter, around the center of the handlebar
+        screw_part_adapter_mirror = mirror(objects=screw_part_adapter,
+                                           about=Plane(Location(handle_bar_center) * Plane.YZ.location))
+        handle_bar_core = robust.fuse(handle_bar_core, screw_part_adapter_mirror, solids=1,
+                                      label="handle_bars.join mirror")
+        del screw_part_adapter, screw_part_adapter_mirror
+
+        # Add the finished handle bar to the crazy side conn curve
+        handlebar_side_conn = robust.fuse(side_conn.value, handle_bar_core, solids=1, label="handle_bars.join")
+        del handle_bar_core
+        return handlebar_side_conn, handle_bar_center
+    join = stage_cache.run("handle_bars.join", join, deps=(side_conn, core, adapter))
+
+    def final_split():
+        handlebar_side_conn, handle_bar_center = join.value
+        handlebar_side_conn = instance(handlebar_side_conn)  # Joints are added below
+        # Cut the handlebar side connector to fit the handlebar
+        RigidJoint("split_joint", handlebar_side_conn, Location(
+            handle_bar_center + (0, 0, 1)))  # "Center" of screw hole
+        del handle_bar_center
+        bb = handlebar_side_conn.bounding_box()
+        cutout = Box(bb.size.X + tol, bb.size.Y + tol, screw_floating_cut)
+        RigidJoint("center", cutout, Location((0, 0, 0)))
+        handlebar_side_conn.joints["split_joint"].connect_to(cutout.joints["center"])
+        handlebar_side_conn = robust.cut(handlebar_side_conn, cutout, solids=2, label="handle_bars.split")
+        del cutout
+
+        # Join a mirrored version of the handlebar side
+        handle_bars_part = handlebar_side_conn
+        handle_bars_part = robust.fuse(handle_bars_part, mirror(objects=handlebar_side_conn), solids=4,
+                                       label="handle_bars.split mirror")
+        del handlebar_side_conn
+        return handle_bars_part
+    return stage_cache.run("handle_bars.split", final_split, (tol, screw_floating_cut), deps=(join,)).value
+
+
+def handle_bars_key(p: HandleBarParams = p, stem_p: StemParams = stem_p,
+                    headset_p: HeadsetScrewParams = headset_p) -> str:
+    return part_cache.key("handle_bars", p, stem_key(stem_p, headset_p),
+                          screwable_cylinder_key(**screwable_cylinder_kwargs), module=__name__)
+
+
+def build_handle_bars(p: HandleBarParams = p, stem_p: StemParams = stem_p,
+                      headset_p: HeadsetScrewParams = headset_p) -> Part:
+    """The handle bars part (for the stem of stem_p and headset_p), built only once per set of parameters"""
+    kernel.install()
+
+    def build():
+        _, stem_side_faces = build_stem(stem_p, headset_p)
+        return [_build(p, stem_p, stem_side_faces,
+                       build_screwable_cylinder(**screwable_cylinder_kwargs))]
+    return part_cache.cached(handle_bars_key(p, stem_p, headset_p), build)[0]
+
+
+def __getattr__(name: str):
+    if name == "handle_bars_part":  # Lazily built on first access
+        return build_handle_bars(p)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 if __name__ == "__main__":  # While developing this single part
+    handle_bars_part = build_handle_bars(p)
     import ocp_vscode
     ocp_vscode.show_all()
@@ -2,6 +2,8 @@
 from dataclasses import dataclass
 from build123d import *
 from bike_stem_mount.parts.global_params import *
+from bike_stem_mount import kernel
+from bike_stem_mount.cache import part_cache
 
 # ================== PARAMETERS ==================
 
@@ -19,60 +21,80 @@ p = HeadsetScrewParams()
 
 # ================== MODELLING ==================
 
-with BuildPart() as headset_screw_part:
-    def outer_wall(radius: float = p.circle_radius):
-        with BuildSketch() as sk1:
-            with BuildLine():  # top_face_outer_line
-                arc = CenterArc((0, 0), radius, 180, -90)
-                Polyline(arc@1, (radius, (arc@1).Y), (radius, 0))
-                del arc
-                mirror()
-            make_face()
-        return sk1
-
-    # Core sketch and extrusion
-    with BuildSketch():
-        add(outer_wall())
-        Circle(radius=p.screw_radius, mode=Mode.SUBTRACT)
-    extrude(amount=p.circle_max_height + wall)
-
-    # Remove a little extra material for the screw head
-    with BuildSketch(Plane.XY.offset(wall)):
-        Circle(radius=p.screw_flat_radius)
-    extrude(amount=p.circle_max_height, mode=Mode.SUBTRACT)
-
-    # Remove a little material for the outer wall of the headset
-    with BuildSketch():
-        add(outer_wall(radius=p.circle_flat_radius + wall))
-        Circle(radius=p.circle_flat_radius, mode=Mode.SUBTRACT)
-    extrude(amount=p.circle_max_height, mode=Mode.SUBTRACT)
-
-    # Final chamfering
-    to_chamfer = headset_screw_part.edges().filter_by(GeomType.CIRCLE).group_by(
-        SortBy.LENGTH)[1].sort_by(Axis.Z)[-1]
-    chamfer(to_chamfer, p.circle_max_height - eps)
-    del to_chamfer
-    to_chamfer = headset_screw_part.edges().filter_by(
-        GeomType.CIRCLE).group_by(Axis.Z)[0]
-    to_chamfer -= to_chamfer.group_by(SortBy.LENGTH)[0]
-    to_chamfer -= to_chamfer.group_by(SortBy.LENGTH)[-2]
-    to_chamfer += headset_screw_part.edges().group_by(Axis.Z)[0].group_by(
-        Axis.X)[-2]
-    chamfer(to_chamfer, p.circle_max_height - eps)
-    del to_chamfer
-
-    # Final filleting
-    to_fillet = headset_screw_part.faces().group_by(Axis.Z)[-1].edges()
-    to_fillet -= to_fillet.group_by(Axis.X)[-1]
-    fillet(to_fillet, p.circle_max_height - wall)
-    del to_fillet
-    to_fillet = headset_screw_part.edges().group_by(
-        Axis.Z)[0].group_by(SortBy.LENGTH)[-1]
-    fillet(to_fillet, wall)
-    del to_fillet
-
-headset_screw_part = headset_screw_part.part
+
+def _build(p: HeadsetScrewParams) -> Part:
+    with BuildPart() as headset_screw_part:
+        def outer_wall(radius: float = p.circle_radius):
+            with BuildSketch() as sk1:
+                with BuildLine():  # top_face_outer_line
+                    arc = CenterArc((0, 0), radius, 180, -90)
+                    Polyline(arc@1, (radius, (arc@1).Y), (radius, 0))
+                    del arc
+                    mirror()
+                make_face()
+            return sk1
+
+        # Core sketch and extrusion
+        with BuildSketch():
+            add(outer_wall())
+            Circle(radius=p.screw_radius, mode=Mode.SUBTRACT)
+        extrude(amount=p.circle_max_height + wall)
+
+        # Remove a little extra material for the screw head
+        with BuildSketch(Plane.XY.offset(wall)):
+            Circle(radius=p.screw_flat_radius)
+        extrude(amount=p.circle_max_height, mode=Mode.SUBTRACT)
+
+        # Remove a little material for the outer wall of the headset
+        with BuildSketch():
+            add(outer_wall(radius=p.circle_flat_radius + wall))
+            Circle(radius=p.circle_flat_radius, mode=Mode.SUBTRACT)
+        extrude(amount=p.circle_max_height, mode=Mode.SUBTRACT)
+
+        # Final chamfering
+        to_chamfer = headset_screw_part.edges().filter_by(GeomType.CIRCLE).group_by(
+            SortBy.LENGTH)[1].sort_by(Axis.Z)[-1]
+        chamfer(to_chamfer, p.circle_max_height - eps)
+        del to_chamfer
+        to_chamfer = headset_screw_part.edges().filter_by(
+            GeomType.CIRCLE).group_by(Axis.Z)[0]
+        to_chamfer -= to_chamfer.group_by(SortBy.LENGTH)[0]
+        to_chamfer -= to_chamfer.group_by(SortBy.LENGTH)[-2]
+        to_chamfer += headset_screw_part.edges().group_by(Axis.Z)[0].group_by(
+            Axis.X)[-2]
+        chamfer(to_chamfer, p.circle_max_height - eps)
+        del to_chamfer
+
+        # Final filleting
+        to_fillet = headset_screw_part.faces().group_by(Axis.Z)[-1].edges()
+        to_fillet -= to_fillet.group_by(Axis.X)[-1]
+        fillet(to_fillet, p.circle_max_height - wall)
+        del to_fillet
+        to_fillet = headset_screw_part.edges().group_by(
+            Axis.Z)[0].group_by(SortBy.LENGTH)[-1]
+        fillet(to_fillet, wall)
+        del to_fillet
+
+    return headset_screw_part.part
+
+
+def headset_screw_key(p: HeadsetScrewParams = p) -> str:
+    return part_cache.key("headset_screw", p, module=__name__)
+
+
+def build_headset_screw(p: HeadsetScrewParams = p) -> Part:
+    """The headset screw part, built only once per set of parameters"""
+    kernel.install()
+    return part_cache.cached(headset_screw_key(p), lambda: [_build(p)])[0]
+
+
+def __getattr__(name: str):
+    if name == "headset_screw_part":  # Lazily built on first access
+        return build_headset_screw(p)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 if __name__ == "__main__":  # While developing this single part
+    headset_screw_part = build_headset_screw(p)
     import ocp_vscode
     ocp_vscode.show_all()
@@ -1,12 +1,65 @@
 # %%
-from dataclasses import dataclass
-from typing import Union
+from copy import deepcopy
+from dataclasses import dataclass, fields
+from typing import Optional, TypeVar, Union
 from build123d import *
+from build123d.topology import Shape, downcast
 from math import *
 from bike_stem_mount.parts.global_params import *
+from bike_stem_mount import kernel
+from bike_stem_mount.cache import part_cache
+from bike_stem_mount.parts.fasteners import Fastener, lookup
+
+# ================== INSTANCES ==================
+
+S = TypeVar("S", bound=Shape)
+
+
+def instance(shape: S, location: Location = Location()) -> S:
+    """A copy of the shape moved by location that shares its geometry (unlike copy() and deepcopy(), which copy it
+    first), for the many identical solids of an assembly. Joints and other attributes are still copied."""
+    cls = type(shape)
+    result = cls.__new__(cls)
+    memo = {id(shape): result, id(shape.wrapped): downcast(shape.wrapped.Moved(location.wrapped))}
+    for key, value in shape.__dict__.items():
+        setattr(result, key, deepcopy(value, memo))
+    for joint in getattr(result, "joints", {}).values():
+        joint.parent = result
+    return result
+
+
+# ================== CUTTERS ==================
+
+
+def fastener_cutter_key(fastener: Fastener, screw_length: float) -> str:
+    return part_cache.key("fastener_cutter", fastener, screw_length, module=__name__)
+
+
+def fastener_cutter(fastener: Fastener, screw_length: float) -> Solid:
+    """The pockets of the fastener (head hole, screw hole and nut hole, with tol) in a cylinder of screw_length plus the
+    head height centered at the origin, built only once per fastener, length and tolerance (and cached on disk), to
+    subtract from any part"""
+    kernel.install()
+
+    def build():
+        total_height = screw_length + fastener.head_height
+        with BuildPart() as cutter:
+            with Locations((0, 0, (total_height - fastener.head_height) / 2)):  # Head hole, from the top
+                Cylinder(fastener.head_diameter/2 + tol, fastener.head_height)
+            Cylinder(fastener.screw_diameter/2 + tol, screw_length)  # Screw hole
+            with BuildSketch(Plane.XY.offset(-total_height / 2)):  # Nut hole, from the bottom
+                RegularPolygon(fastener.nut_width/2 + tol, 6, major_radius=False)
+            extrude(amount=fastener.nut_height)
+        return [cutter.part.solid()]
+    return part_cache.cached(fastener_cutter_key(fastener, screw_length), build)[0]
+
 
 # ================== MODELLING ==================
 
+_PLACEMENT_FIELDS = ("rotation", "align", "mode")
+_shapes: dict[tuple, Part] = {}
+"""Unplaced geometry of each ScrewableCylinder (by its other fields), shared by all its instances"""
+
 
 @dataclass(kw_only=True)
 class ScrewableCylinder(BasePartObject):
@@ -18,11 +71,18 @@ class ScrewableCylinder(BasePartObject):
     nut_height: float = 2.7  # M5
     wall_size: float = wall
     round: bool = False
+    fastener: Optional[str] = None
+    """Name of the fastener (see fasteners.lookup), e.g. "M4" or "M3-button-thin", replacing the screw and nut fields"""
     rotation: RotationLike = (0, 0, 0)
     align: Union[Align, tuple[Align, Align, Align]] = None
     mode: Mode = Mode.ADD
 
-    def __post_init__(self):
+    def hardware(self) -> Fastener:
+        """The fastener of the screw and nut fields"""
+        return Fastener("M%g" % self.screw_diameter, "custom", "custom", self.screw_diameter, self.screw_head_diameter,
+                        self.screw_head_height, self.nut_inscribed_diameter, self.nut_height)
+
+    def _build(self) -> Part:
         with BuildPart() as part:
             total_height = self.screw_length + self.screw_head_height
             max_hole_diameter = max(
@@ -32,20 +92,37 @@ class ScrewableCylinder(BasePartObject):
             Cylinder(max_hole_diameter/2 + self.wall_size, total_height)
             if self.round:
                 fillet(edges(), radius=self.wall_size)
-            # Top hole
-            with BuildSketch(faces() >> Axis.Z):
-                Circle(self.screw_head_diameter/2 + tol)
-            extrude(amount=-self.screw_head_height, mode=Mode.SUBTRACT)
-            # Screw hole
-            Cylinder(self.screw_diameter/2 + tol,
-                     self.screw_length, mode=Mode.SUBTRACT)
-            # Nut hole
-            with BuildSketch(faces() << Axis.Z):
-                RegularPolygon(self.nut_inscribed_diameter/2 +
-                               tol, 6, major_radius=False)
-            extrude(amount=-self.nut_height, mode=Mode.SUBTRACT)
-        super().__init__(part=part.part, rotation=self.rotation,
-                         align=self.align, mode=self.mode)
+            # Top, screw and nut holes
+            add(fastener_cutter(self.hardware(), self.screw_length), mode=Mode.SUBTRACT)
+        return part.part
+
+    def __post_init__(self):
+        if self.fastener is not None:
+            fastener = lookup(self.fastener)
+            self.screw_diameter, self.screw_head_diameter = fastener.screw_diameter, fastener.head_diameter
+            self.screw_head_height = fastener.head_height
+            self.nut_inscribed_diameter, self.nut_height = fastener.nut_width, fastener.nut_height
+        key = (tol,) + tuple(getattr(self, f.name) for f in fields(self) if f.name not in _PLACEMENT_FIELDS)
+        if key not in _shapes:
+            _shapes[key] = self._build()
+        shape = _shapes[key]
+        if self.align is None and BuildPart._get_context(self, log=False) is None:
+            # Standalone: place an instance instead of letting BasePartObject copy the geometry
+            self.rotation = Rotation(*self.rotation) if isinstance(self.rotation, tuple) else self.rotation
+            Part.__init__(self, obj=instance(shape, self.rotation).wrapped, label=shape.label)
+        else:
+            super().__init__(part=instance(shape), rotation=self.rotation,
+                             align=self.align, mode=self.mode)
+
+
+def screwable_cylinder_key(**kwargs) -> str:
+    return part_cache.key("screwable_cylinder", kwargs, module=__name__)
+
+
+def build_screwable_cylinder(**kwargs) -> Part:
+    """A standalone ScrewableCylinder (see its fields for kwargs), built only once per set of parameters"""
+    kernel.install()
+    return part_cache.cached(screwable_cylinder_key(**kwargs), lambda: [ScrewableCylinder(**kwargs)])[0]
 
 
 if __name__ == "__main__":
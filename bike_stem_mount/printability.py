@@ -0,0 +1,247 @@
+# %%
+import argparse
+import dataclasses
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from build123d import Shape
+from bike_stem_mount.export import QUALITY_PRESETS, Mesh, Quality, merge, piece_sizes, read_stl, \
+    tessellate_solids, write_3mf
+from bike_stem_mount.parts import global_params
+
+# ================== PRINTABILITY ANALYSIS ==================
+# Overhangs, support area and wall thickness of the tessellated pieces, computed per triangle with NumPy only, so
+# that problems show up before slicing (and cheaply enough to analyze every variant of a sweep). Wall thickness is
+# measured by casting a ray inward from the center of each triangle: a uniform grid (with cells as large as the
+# longest ray) pairs each ray with the triangles of the cells it crosses, and the pairs are intersected in batches.
+
+
+@dataclass
+class PrintabilityParams:
+    up: tuple[float, float, float] = (0, 0, 1)
+    """Print direction (the build plate is below the lowest point of each piece)"""
+    max_overhang: float = 50
+    """Maximum angle from vertical of downward-facing triangles printed without supports"""
+    bed: float = field(default_factory=lambda: global_params.tol)
+    """Triangles this close to the lowest point of a piece lie on the build plate"""
+    min_wall: float = field(default_factory=lambda: global_params.wall_min)
+    """Minimum wall thickness"""
+    max_thickness: float = field(default_factory=lambda: 2 * global_params.wall)
+    """Walls thicker than this are not measured (longer rays are slower)"""
+
+
+p = PrintabilityParams()
+
+COLORS = ["#b4b4b4", "#e8743b", "#3b7dd8", "#9b3bd8"]
+"""Triangle colors: printable, overhang, thin wall, both"""
+
+
+@dataclass
+class Analysis:
+    """Per-triangle results for a mesh"""
+    mesh: Mesh
+    areas: np.ndarray
+    overhang: np.ndarray
+    """Angle from vertical of downward-facing triangles (0 for the rest)"""
+    needs_support: np.ndarray
+    support_area: np.ndarray
+    """Area projected onto the build plate of the triangles needing support"""
+    thickness: np.ndarray
+    """Wall thickness inward from the center of the triangle (inf if thicker than max_thickness)"""
+    thin: np.ndarray
+
+    def colors(self) -> np.ndarray:
+        """Index in COLORS of each triangle"""
+        return self.needs_support.astype(np.int64) + 2 * self.thin.astype(np.int64)
+
+    def summary(self, sliver: float = 1e-3) -> dict[str, Optional[float]]:
+        """Totals, and the thinnest wall ignoring the given fraction of the area (slivers along sharp edges), or None if
+        all walls are thicker than max_thickness"""
+        order = np.argsort(self.thickness)
+        thinnest = self.thickness[order[min(np.searchsorted(np.cumsum(self.areas[order]), sliver * self.areas.sum()),
+                                            len(order) - 1)]] if len(order) else np.inf
+        return {"triangles": len(self.areas),
+                "area": round(float(self.areas.sum()), 2),
+                "overhang_area": round(float(self.areas[self.needs_support].sum()), 2),
+                "support_area": round(float(self.support_area.sum()), 2),
+                "max_overhang": round(float(self.overhang[self.needs_support].max(initial=0)), 1),
+                "thin_area": round(float(self.areas[self.thin].sum()), 2),
+                "min_wall": round(float(thinnest), 3) if np.isfinite(thinnest) else None}
+
+
+def combine(analyses: list[Analysis]) -> Analysis:
+    """A single analysis of several meshes (e.g. the solids of a printable piece)"""
+    return Analysis(merge([analysis.mesh for analysis in analyses]), *(
+        np.concatenate([getattr(analysis, f.name) for analysis in analyses]) for f in dataclasses.fields(Analysis)[1:]))
+
+
+def _covered_cells(lo: np.ndarray, hi: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The owner (row) and integer coordinates of every cell of the boxes lo..hi (N x 3, inclusive)"""
+    spans = hi - lo + 1
+    counts = spans.prod(axis=1)
+    owners = np.repeat(np.arange(len(lo)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    sy, sz = spans[owners, 1], spans[owners, 2]
+    return owners, lo[owners] + np.column_stack([k // (sy * sz), k // sz % sy, k % sz])
+
+
+def exit_distances(mesh: Mesh, normals: np.ndarray, origins: np.ndarray, directions: np.ndarray,
+                   max_distance: float, batch: int = 1 << 21) -> np.ndarray:
+    """Distance along each (unit) direction to the nearest triangle facing along it, i.e. where the ray leaves a closed
+    mesh (inf if there is none within max_distance)"""
+    vertices, triangles = mesh
+    corners = vertices[triangles]
+    # Rays and triangles are listed in all the (small) cells crossed by their bounding boxes, and a pair is only tested
+    # in the first cell they share (the cell of the max of their min corners), as they might share several
+    cell = max_distance / 4
+    ends = origins + directions * max_distance
+    tri_lo = np.floor(corners.min(axis=1) / cell).astype(np.int64)
+    ray_lo = np.floor(np.minimum(origins, ends) / cell).astype(np.int64)
+    tri_owners, tri_cells = _covered_cells(tri_lo, np.floor(corners.max(axis=1) / cell).astype(np.int64))
+    ray_owners, ray_cells = _covered_cells(ray_lo, np.floor(np.maximum(origins, ends) / cell).astype(np.int64))
+    base = np.minimum(tri_cells.min(axis=0, initial=0), ray_cells.min(axis=0, initial=0))
+    dims = np.maximum(tri_cells.max(axis=0, initial=0), ray_cells.max(axis=0, initial=0)) - base + 1
+    tri_keys = np.ravel_multi_index((tri_cells - base).T, dims)
+    ray_keys = np.ravel_multi_index((ray_cells - base).T, dims)
+    order = np.argsort(tri_keys)
+    tri_keys, tri_owners = tri_keys[order], tri_owners[order]
+    start = np.searchsorted(tri_keys, ray_keys, "left")
+    counts = np.searchsorted(tri_keys, ray_keys, "right") - start
+    offsets = np.cumsum(counts) - counts
+
+    v0 = corners[:, 0]
+    e1, e2 = corners[:, 1] - v0, corners[:, 2] - v0
+    distances = np.full(len(origins), np.inf)
+    # Batches of whole ray cells, to bound the memory
+    bounds = np.searchsorted(offsets, np.arange(0, counts.sum() + batch, batch))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if first == last:
+            continue
+        n = counts[first:last]
+        entries = np.repeat(np.arange(first, last), n)
+        r = ray_owners[entries]
+        t = tri_owners[np.repeat(start[first:last] - offsets[first:last], n) +
+                       np.arange(offsets[first], offsets[first] + n.sum())]
+        first_cell = np.all(ray_cells[entries] == np.maximum(ray_lo[r], tri_lo[t]), axis=1)
+        r, t = r[first_cell], t[first_cell]
+        # Cheap plane test first: facing along the ray, and crossed within max_distance
+        d = directions[r]
+        facing = np.einsum("ij,ij->i", normals[t], d)
+        plane = np.einsum("ij,ij->i", normals[t], v0[t] - origins[r])
+        keep = (facing > 1e-9) & (plane > 1e-6 * facing) & (plane <= max_distance * facing)
+        r, t, d = r[keep], t[keep], d[keep]
+        # Möller–Trumbore for the rest
+        a, b = e1[t], e2[t]
+        pvec = np.cross(d, b)
+        inv = 1 / np.einsum("ij,ij->i", a, pvec)  # Not parallel, as they face along the ray
+        s = origins[r] - v0[t]
+        u = np.einsum("ij,ij->i", s, pvec) * inv
+        qvec = np.cross(s, a)
+        v = np.einsum("ij,ij->i", d, qvec) * inv
+        hit = (u >= 0) & (v >= 0) & (u + v <= 1)
+        np.minimum.at(distances, r[hit], np.einsum("ij,ij->i", b[hit], qvec[hit]) * inv[hit])
+    return distances
+
+
+def analyze(mesh: Mesh, params: PrintabilityParams = p, bed: Optional[float] = None) -> Analysis:
+    """Printability of a closed mesh printed in the params.up direction, on a build plate at the given height (along
+    params.up, by default that of the lowest point of the mesh)"""
+    vertices, triangles = mesh
+    corners = vertices[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1) / 2
+    normals /= np.maximum(2 * areas, 1e-12)[:, None]
+    up = np.asarray(params.up, dtype=np.float64) / np.linalg.norm(params.up)
+
+    down = np.clip(-normals @ up, 0, 1)
+    overhang = np.degrees(np.arcsin(down))
+    heights = corners @ up
+    if bed is None:
+        bed = heights.min(initial=np.inf)
+    needs_support = (overhang > params.max_overhang) & (heights.max(axis=1, initial=-np.inf) > bed + params.bed)
+
+    thickness = exit_distances(mesh, normals, corners.mean(axis=1), -normals, params.max_thickness)
+    return Analysis(mesh, areas, overhang, needs_support, np.where(needs_support, areas * down, 0), thickness,
+                    thickness < params.min_wall)
+
+
+def analyze_pieces(shape: Shape, params: PrintabilityParams = p, quality: Quality = QUALITY_PRESETS["print"],
+                   max_workers: Optional[int] = None) -> list[Analysis]:
+    """One analysis per printable piece of the shape. The solids of a piece are analyzed separately (so that the
+    overlapping parts don't look like thin walls), each printed on the build plate of the piece."""
+    meshes = tessellate_solids(shape, quality, max_workers)
+    up = np.asarray(params.up, dtype=np.float64) / np.linalg.norm(params.up)
+    analyses, start = [], 0
+    for size in piece_sizes(shape):
+        piece = meshes[start:start + size]
+        bed = min((vertices @ up).min(initial=np.inf) for vertices, _ in piece)
+        analyses.append(combine([analyze(mesh, params, bed) for mesh in piece]))
+        start += size
+    return analyses
+
+
+def write_ply(path: Path, analyses: list[Analysis]):
+    """Binary PLY of all the analyzed meshes, with the color of each triangle (see COLORS)"""
+    vertices, triangles = merge([analysis.mesh for analysis in analyses])
+    colors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in COLORS], dtype=np.uint8)
+    faces = np.zeros(len(triangles), dtype=[("count", "u1"), ("vertices", "<i4", 3), ("color", "u1", 3)])
+    faces["count"] = 3
+    faces["vertices"] = triangles
+    faces["color"] = colors[np.concatenate([analysis.colors() for analysis in analyses])]
+    with open(path, "wb") as f:
+        f.write(("ply\nformat binary_little_endian 1.0\ncomment bike_stem_mount printability\n"
+                 "element vertex %d\nproperty float x\nproperty float y\nproperty float z\n"
+                 "element face %d\nproperty list uchar int vertex_indices\n"
+                 "property uchar red\nproperty uchar green\nproperty uchar blue\nend_header\n" % (
+                     len(vertices), len(triangles))).encode())
+        f.write(vertices.astype("<f4").tobytes())
+        f.write(faces.tobytes())
+
+
+def write_colored(path: Path, analyses: list[Analysis]):
+    """PLY or 3MF (by extension) with the triangles colored by the analysis"""
+    if Path(path).suffix.lower() == ".3mf":
+        write_3mf(path, [analysis.mesh for analysis in analyses], ["piece-%d" % i for i in range(len(analyses))],
+                  COLORS, [analysis.colors() for analysis in analyses])
+    elif Path(path).suffix.lower() == ".ply":
+        write_ply(path, analyses)
+    else:
+        raise ValueError("Unsupported format %r (expected .ply or .3mf)" % Path(path).suffix)
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Analyzes overhangs, support area and wall thickness of the "
+                                                 "tessellated assembly (or an STL file)")
+    parser.add_argument("input", type=Path, nargs="?", help="STL file (default: the built assembly)")
+    parser.add_argument("--quality", choices=list(QUALITY_PRESETS), default="print")
+    parser.add_argument("--up", default="0,0,1", help="Print direction as x,y,z")
+    parser.add_argument("--max-overhang", type=float, default=p.max_overhang,
+                        help="Maximum angle from vertical of downward-facing triangles printed without supports")
+    parser.add_argument("--min-wall", type=float, help="Minimum wall thickness (default: wall_min)")
+    parser.add_argument("--out", nargs="*", type=Path, default=[], help="Colored .ply or .3mf files to write")
+    parser.add_argument("--json", type=Path, help="Also write the summary to this JSON file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        parts = from_args(args).params()  # Before the defaults derived from the global parameters
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+    params = PrintabilityParams(up=tuple(float(x) for x in args.up.split(",")), max_overhang=args.max_overhang,
+                                **({} if args.min_wall is None else {"min_wall": args.min_wall}))
+    if args.input:
+        analyses = [analyze(read_stl(args.input), params)]
+    else:
+        from bike_stem_mount.main import build_assembly
+        analyses = analyze_pieces(build_assembly(**parts), params, QUALITY_PRESETS[args.quality])
+    summaries = [analysis.summary() for analysis in analyses]
+    for i, summary in enumerate(summaries):
+        print("Piece %d: %s" % (i, ", ".join("%s=%s" % item for item in summary.items())))
+    for path in args.out:
+        write_colored(path, analyses)
+        print("Wrote %s" % path)
+    if args.json:
+        args.json.write_text(json.dumps(summaries, indent=2))
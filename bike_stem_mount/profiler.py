@@ -0,0 +1,196 @@
+# %%
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+import build123d
+from build123d import Shape, ShapeList, Solid
+from bike_stem_mount.cache import rss
+
+# ================== PROFILER ==================
+# Wraps the build123d operations used by the parts (and the robust.py operations) to time them and attribute them to the
+# line of the part script that called them. Operations may nest (e.g. fillet() calls Shape.fillet()), so both total and
+# self times are recorded.
+
+OPERATIONS = ["add", "chamfer", "extrude", "fillet", "loft", "make_face", "mirror", "offset", "revolve", "split",
+              "sweep"]
+"""build123d functions to wrap"""
+METHODS = ["chamfer", "clean", "cut", "fillet", "fuse", "intersect", "split"]
+"""Shape methods to wrap"""
+ROBUST_OPERATIONS = ["cut", "fillet", "fuse"]
+"""robust.py functions to wrap (called as robust.<name> by the parts)"""
+
+_PACKAGE_DIR = str(Path(__file__).parent)
+
+
+def _counts(objs) -> tuple[int, int]:
+    """Number of faces and edges of all shapes in objs"""
+    faces = edges = 0
+    for obj in objs:
+        if isinstance(obj, (list, tuple, ShapeList)):
+            sub_faces, sub_edges = _counts(obj)
+            faces, edges = faces + sub_faces, edges + sub_edges
+        elif isinstance(obj, Shape) and obj.wrapped is not None:
+            faces, edges = faces + len(obj.faces()), edges + len(obj.edges())
+    return faces, edges
+
+
+def _caller() -> str:
+    """The first frame of this package (but not this module) calling the operation"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        file = frame.f_code.co_filename
+        if file.startswith(_PACKAGE_DIR) and file != __file__:
+            return "%s:%d" % (os.path.relpath(file, _PACKAGE_DIR), frame.f_lineno)
+        frame = frame.f_back
+    return "<unknown>"
+
+
+@dataclass
+class Record:
+    op: str
+    location: str
+    depth: int
+    start: float
+    seconds: float = 0.0
+    self_seconds: float = 0.0
+    rss_delta: int = 0
+    faces_in: int = 0
+    edges_in: int = 0
+    faces_out: int = 0
+    edges_out: int = 0
+    nested: bool = False
+    """Whether it was called (indirectly) by a call of the same operation and location"""
+
+
+class Profiler:
+    """Context manager that records every wrapped operation while active"""
+
+    def __init__(self, count_topology: bool = True):
+        self.count_topology = count_topology
+        self.records: list[Record] = []
+        self._stack: list[Record] = []
+        self._patches: list[tuple[Any, str, Any]] = []
+        self._start = 0.0
+
+    def _wrap(self, op: str, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            record = Record(op, _caller(), len(self._stack), 0.0)
+            record.nested = any(r.op == record.op and r.location == record.location for r in self._stack)
+            if self.count_topology:
+                record.faces_in, record.edges_in = _counts(list(args) + list(kwargs.values()))
+            self._stack.append(record)
+            rss_before = rss()
+            record.start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                record.seconds = time.perf_counter() - record.start
+                record.rss_delta = rss() - rss_before
+                self._stack.pop()
+                record.self_seconds += record.seconds  # Minus the time of the children, already subtracted
+                if self._stack:
+                    self._stack[-1].self_seconds -= record.seconds
+                self.records.append(record)
+            if self.count_topology:
+                record.faces_out, record.edges_out = _counts([result])
+            return result
+        return wrapper
+
+    def _patch(self, owner: Any, name: str, op: str):
+        original = owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)
+        self._patches.append((owner, name, original))
+        setattr(owner, name, self._wrap(op, original))
+
+    def __enter__(self) -> "Profiler":
+        wrapped = {}
+        for name in OPERATIONS:
+            wrapped[getattr(build123d, name)] = name
+            self._patch(build123d, name, name)
+        # Also patch the names already imported by the part scripts (from build123d import *)
+        for module in list(sys.modules.values()):
+            if module is not None and module.__name__.startswith("bike_stem_mount") and module.__name__ != __name__:
+                for name, value in list(vars(module).items()):
+                    if callable(value) and value in wrapped:
+                        self._patch(module, name, wrapped[value])
+        for name in METHODS:
+            owner = next(cls for cls in Solid.__mro__ if name in cls.__dict__)
+            self._patch(owner, name, "%s.%s" % (owner.__name__, name))
+        from bike_stem_mount import robust
+        for name in ROBUST_OPERATIONS:
+            self._patch(robust, name, "robust." + name)
+        # Their attempts in this process instead of robust.py's worker, to profile the OCCT operations too
+        self._patches.append((robust.settings, "timeout", robust.settings.timeout))
+        robust.settings.timeout = None
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        for owner, name, original in reversed(self._patches):
+            setattr(owner, name, original)
+        self._patches.clear()
+
+    def summary(self) -> list[dict[str, Any]]:
+        """Records aggregated by operation and source line, sorted by self time"""
+        groups = defaultdict(list)
+        for record in self.records:
+            groups[(record.op, record.location)].append(record)
+        rows = [{
+            "op": op, "location": location, "calls": len(records),
+            "seconds": sum(r.seconds for r in records if not r.nested),
+            "self_seconds": sum(r.self_seconds for r in records),
+            "max_seconds": max(r.seconds for r in records),
+            "rss_delta": sum(r.rss_delta for r in records if r.depth == 0),
+            "faces_in": sum(r.faces_in for r in records), "faces_out": sum(r.faces_out for r in records),
+            "edges_in": sum(r.edges_in for r in records), "edges_out": sum(r.edges_out for r in records),
+        } for (op, location), records in groups.items()]
+        return sorted(rows, key=lambda row: row["self_seconds"], reverse=True)
+
+    def report(self, limit: Optional[int] = 30) -> str:
+        rows = self.summary()[:limit]
+        lines = ["%-24s %-26s %6s %9s %9s %9s %9s %13s %13s" % (
+            "operation", "location", "calls", "self (s)", "total (s)", "max (s)", "RSS (MB)", "faces in/out",
+            "edges in/out")]
+        for row in rows:
+            lines.append("%-24s %-26s %6d %9.3f %9.3f %9.3f %9.1f %13s %13s" % (
+                row["op"], row["location"], row["calls"], row["self_seconds"], row["seconds"], row["max_seconds"],
+                row["rss_delta"] / 2 ** 20, "%d/%d" % (row["faces_in"], row["faces_out"]),
+                "%d/%d" % (row["edges_in"], row["edges_out"])))
+        total = sum(r.seconds for r in self.records if r.depth == 0)
+        lines.append("Total time in profiled operations: %.3fs" % total)
+        return "\n".join(lines)
+
+    def trace(self) -> dict[str, Any]:
+        """Chrome trace event format, viewable as a flame graph in e.g. https://www.speedscope.app"""
+        return {"traceEvents": [{
+            "name": record.op, "cat": "build123d", "ph": "X", "pid": os.getpid(), "tid": 0,
+            "ts": (record.start - self._start) * 1e6, "dur": record.seconds * 1e6,
+            "args": {k: v for k, v in asdict(record).items() if k not in ("op", "start")},
+        } for record in sorted(self.records, key=lambda r: r.start)], "displayTimeUnit": "ms"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profiles a full (uncached) build of the assembly")
+    parser.add_argument("--trace", type=Path, help="Write a JSON trace (Chrome trace event format) to this file")
+    parser.add_argument("--summary", type=Path, help="Write the JSON summary to this file")
+    parser.add_argument("--limit", type=int, default=30, help="Rows of the printed report")
+    parser.add_argument("--no-topology", action="store_true", help="Don't count faces and edges (faster)")
+    args = parser.parse_args()
+
+    from bike_stem_mount.cache import part_cache
+    from bike_stem_mount.main import build_assembly
+    part_cache.enabled = False  # Otherwise there is nothing to profile
+    with Profiler(count_topology=not args.no_topology) as profiler:
+        build_assembly(workers=1)
+    print(profiler.report(args.limit))
+    if args.trace:
+        args.trace.write_text(json.dumps(profiler.trace()))
+    if args.summary:
+        args.summary.write_text(json.dumps(profiler.summary(), indent=2))
@@ -0,0 +1,275 @@
+# %%
+import argparse
+import hashlib
+import os
+import shutil
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+import numpy as np
+from build123d import Compound, ExportSVG, LineType, Shape
+from OCP.gp import gp_Ax2, gp_Dir, gp_Pnt
+from OCP.HLRAlgo import HLRAlgo_Projector
+from OCP.HLRBRep import HLRBRep_PolyAlgo, HLRBRep_PolyHLRToShape
+from bike_stem_mount.cache import from_brep, part_cache, to_brep
+from bike_stem_mount.export import QUALITY_PRESETS, Mesh, tessellate, triangulate
+
+# ================== HEADLESS RENDERING ==================
+# PNG views are rasterized in software from a draft mesh of each solid with a NumPy z-buffer, and SVG views are
+# hidden-line projections of the same mesh computed by OCCT, so neither needs a GPU or a viewer. Renders are cached next
+# to the part cache, named after the key of the rendered part, and all missing views are rendered in parallel.
+
+
+@dataclass(frozen=True)
+class View:
+    direction: tuple[float, float, float]
+    """From the center of the shape towards the (orthographic) camera"""
+    up: tuple[float, float, float] = (0, 0, 1)
+
+
+VIEWS = {
+    "iso": View((1, -1, 1)),
+    "front": View((0, -1, 0)),
+    "right": View((1, 0, 0)),
+    "top": View((0, 0, 1), (0, 1, 0)),
+}
+FORMATS = ("png", "svg")
+PALETTE = np.array([(0.30, 0.55, 0.85), (0.90, 0.55, 0.20), (0.35, 0.70, 0.40), (0.80, 0.35, 0.45),
+                    (0.60, 0.45, 0.80), (0.85, 0.75, 0.30)])
+"""Colors of the printable pieces (or solids) of the rendered shape"""
+
+_RENDERER_HASH = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:8]
+
+
+def _basis(view: View) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Towards the camera, screen right and screen up"""
+    towards = np.array(view.direction, dtype=float)
+    towards /= np.linalg.norm(towards)
+    right = np.cross(view.up, towards)
+    right /= np.linalg.norm(right)
+    return towards, right, np.cross(towards, right)
+
+
+def _pieces(shapes: list[Shape]) -> list[Shape]:
+    """What to color differently: the pieces of an assembly, or the solids of a part"""
+    return shapes if len(shapes) > 1 else shapes[0].solids()
+
+
+def rasterize(meshes: list[Mesh], view: View, size: int = 800, supersample: int = 2) -> np.ndarray:
+    """Flat-shaded RGB image (size x size x 3 uint8) of the meshes with outlines, one color per mesh"""
+    res = size * supersample
+    towards, right, up = _basis(view)
+    corners = np.concatenate([vertices[triangles] for vertices, triangles in meshes])  # T x 3 x 3
+    colors = np.concatenate([np.tile(PALETTE[i % len(PALETTE)], (len(triangles), 1))
+                             for i, (_, triangles) in enumerate(meshes)])
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    facing = normals @ towards > 0  # Back faces of closed solids are always hidden
+    corners, colors, normals = corners[facing], colors[facing], normals[facing]
+    light = towards + 0.4 * up + 0.2 * right
+    colors = colors * (0.35 + 0.65 * np.clip(normals @ (light / np.linalg.norm(light)), 0, 1))[:, None]
+
+    # Orthographic projection, fitting the shape in the image with a margin
+    points = np.concatenate([vertices for vertices, _ in meshes])
+    sx, sy = points @ right, points @ up
+    scale = res * 0.9 / max(np.ptp(sx), np.ptp(sy), 1e-9)
+    center = np.array([(sx.max() + sx.min()) / 2, (sy.max() + sy.min()) / 2])
+    x = (corners @ right - center[0]) * scale + res / 2
+    y = res / 2 - (corners @ up - center[1]) * scale
+    z = corners @ towards
+
+    # Fragments of each triangle, as the pixel spans of each of the rows it covers
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    keep = np.abs(area) > 1e-12
+    x, y, z, area = x[keep], y[keep], z[keep], area[keep]
+    triangles = np.flatnonzero(keep)
+    gx = ((z[:, 1] - z[:, 0]) * (y[:, 2] - y[:, 0]) - (z[:, 2] - z[:, 0]) * (y[:, 1] - y[:, 0])) / area
+    gy = ((x[:, 1] - x[:, 0]) * (z[:, 2] - z[:, 0]) - (x[:, 2] - x[:, 0]) * (z[:, 1] - z[:, 0])) / area
+    first_row = np.clip(np.ceil(y.min(axis=1) - 0.5), 0, res).astype(int)
+    rows = np.maximum(np.clip(np.floor(y.max(axis=1) - 0.5), -1, res - 1).astype(int) - first_row + 1, 0)
+    tri = np.repeat(np.arange(len(x)), rows)
+    row = first_row[tri] + np.arange(len(tri)) - np.repeat(np.cumsum(rows) - rows, rows)
+    center_y = row + 0.5
+    span_start, span_end = np.full(len(tri), np.inf), np.full(len(tri), -np.inf)
+    for i in range(3):
+        xa, ya, xb, yb = x[tri, i], y[tri, i], x[tri, (i + 1) % 3], y[tri, (i + 1) % 3]
+        crosses = (np.minimum(ya, yb) <= center_y) & (center_y <= np.maximum(ya, yb)) & (ya != yb)
+        at = xa + (center_y - ya) / np.where(crosses, yb - ya, 1) * (xb - xa)
+        span_start = np.where(crosses, np.minimum(span_start, at), span_start)
+        span_end = np.where(crosses, np.maximum(span_end, at), span_end)
+    span_start = np.clip(np.ceil(span_start - 0.5), 0, res).astype(int)
+    span_end = np.clip(np.floor(span_end - 0.5), -1, res - 1).astype(int)
+    pixels = np.maximum(span_end - span_start + 1, 0)
+    span = np.repeat(np.arange(len(tri)), pixels)
+    px = span_start[span] + np.arange(len(span)) - np.repeat(np.cumsum(pixels) - pixels, pixels)
+    py, tri = row[span], tri[span]
+    pixel = py * res + px
+    depth = z[tri, 0] + gx[tri] * (px + 0.5 - x[tri, 0]) + gy[tri] * (py + 0.5 - y[tri, 0])
+    triangle = triangles[tri]
+
+    # Z-buffer: keep the fragment closest to the camera of each pixel
+    order = np.lexsort((-depth, pixel))
+    pixel, first = np.unique(pixel[order], return_index=True)
+    depth, triangle = depth[order][first], triangle[order][first]
+    image = np.ones((res * res, 3))
+    image[pixel] = colors[triangle]
+    depth_buffer = np.full(res * res, -np.inf)
+    depth_buffer[pixel] = depth
+    normal_buffer = np.zeros((res * res, 3))
+    normal_buffer[pixel] = normals[triangle]
+
+    # Outlines: silhouettes, occlusions (depth jumps) and sharp edges (normal changes)
+    depth_buffer, normal_buffer = depth_buffer.reshape(res, res), normal_buffer.reshape(res, res, 3)
+    background = np.isinf(depth_buffer)
+    depth_buffer = np.where(background, 0, depth_buffer)
+    outline = np.zeros((res, res), dtype=bool)
+    for a, b in (((slice(1, None), slice(None)), (slice(None, -1), slice(None))),
+                 ((slice(None), slice(1, None)), (slice(None), slice(None, -1)))):
+        outline[a] |= (background[a] != background[b]) | ~background[a] & (
+            (np.abs(depth_buffer[a] - depth_buffer[b]) > 8 / scale) |
+            (np.sum(normal_buffer[a] * normal_buffer[b], axis=-1) < 0.75))
+    image = image.reshape(res, res, 3)
+    image[outline] = 0.15
+    image = image.reshape(size, supersample, size, supersample, 3).mean(axis=(1, 3))  # Anti-aliasing
+    return np.round(image * 255).astype(np.uint8)
+
+
+def write_png(path: Path, image: np.ndarray):
+    """8-bit RGB PNG, without any imaging library"""
+    height, width, _ = image.shape
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, width * 3)], axis=1)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+                chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def write_svg(path: Path, shapes: list[Shape], view: View):
+    """Visible and (dotted) hidden edges of the shapes, projected from their draft mesh (much faster than an exact
+    hidden-line removal, and indistinguishable at the size of a preview)"""
+    shape = Compound(list(shapes))
+    triangulate(shape, QUALITY_PRESETS["draft"])
+    towards, _, up = _basis(view)
+    axes = gp_Ax2(gp_Pnt(0, 0, 0), gp_Dir(*towards))
+    axes.SetYDirection(gp_Dir(*up))
+    algo = HLRBRep_PolyAlgo(shape.wrapped)
+    algo.Projector(HLRAlgo_Projector(axes))
+    algo.Update()
+    projection = HLRBRep_PolyHLRToShape()
+    projection.Update(algo)
+    exporter = ExportSVG(margin=5)
+    exporter.add_layer("hidden", line_color=(160, 160, 160), line_weight=0.2, line_type=LineType.ISO_DOT)
+    exporter.add_layer("visible", line_weight=0.3)
+    for layer, compounds in (("hidden", (projection.HCompound(), projection.OutLineHCompound(),
+                                          projection.Rg1LineHCompound())),
+                             ("visible", (projection.VCompound(), projection.OutLineVCompound(),
+                                          projection.Rg1LineVCompound()))):
+        edges = [edge for compound in compounds if not compound.IsNull() for edge in Compound(compound).edges()]
+        if edges:
+            exporter.add_shape(edges, layer=layer)
+    exporter.write(str(path))
+
+
+def _render(data: bytes, view: str, fmt: str, size: int, path: Path) -> float:
+    start = time.perf_counter()
+    shapes = from_brep(data)
+    tmp = path.with_name("%s.tmp%d%s" % (path.stem, os.getpid(), path.suffix))
+    if fmt == "png":
+        write_png(tmp, rasterize([tessellate(piece, QUALITY_PRESETS["draft"]) for piece in _pieces(shapes)],
+                                 VIEWS[view], size))
+    else:
+        write_svg(tmp, shapes, VIEWS[view])
+    os.replace(tmp, path)  # Atomic, for concurrent renders
+    return time.perf_counter() - start
+
+
+def _targets(params: dict[str, Any]) -> dict[str, tuple[str, Callable[[], list[Shape]]]]:
+    """Cache key and builder of the assembly and of each part, with the given build_assembly() arguments (default
+    parameters if omitted)"""
+    from bike_stem_mount.main import assembly_key, build_assembly
+    from bike_stem_mount.parts.headset_screw import build_headset_screw, headset_screw_key, p as headset_p
+    from bike_stem_mount.parts.stem import build_stem, stem_key, p as stem_p
+    from bike_stem_mount.parts.handle_bars import build_handle_bars, handle_bars_key, p as handle_bars_p
+    headset_p, stem_p, handle_bars_p = (params.get(name, default) for name, default in (
+        ("headset_p", headset_p), ("stem_p", stem_p), ("handle_bars_p", handle_bars_p)))
+    return {  # The assembly first, so that its parts are built in parallel
+        "assembly": (assembly_key(headset_p, stem_p, handle_bars_p),
+                     lambda: list(build_assembly(headset_p, stem_p, handle_bars_p))),
+        "headset_screw": (headset_screw_key(headset_p), lambda: [build_headset_screw(headset_p)]),
+        "stem": (stem_key(stem_p, headset_p), lambda: [build_stem(stem_p, headset_p)[0]]),
+        "handle_bars": (handle_bars_key(handle_bars_p, stem_p, headset_p),
+                        lambda: [build_handle_bars(handle_bars_p, stem_p, headset_p)]),
+    }
+
+
+def render(names: Optional[list[str]] = None, views: tuple[str, ...] = tuple(VIEWS), formats: tuple[str, ...] = FORMATS,
+           size: int = 800, out_dir: Path = Path("renders"), max_workers: Optional[int] = None,
+           params: Optional[dict[str, Any]] = None) -> list[Path]:
+    """Renders the views of the targets (default: all) into out_dir as <target>-<view>.<format>, reusing the renders
+    cached for the same part keys, and returns the written files. params are the build_assembly() arguments (see
+    Config.params())"""
+    for view in views:
+        if view not in VIEWS:
+            raise ValueError("Unknown view %r (expected one of %s)" % (view, ", ".join(VIEWS)))
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format %r (expected one of %s)" % (fmt, ", ".join(FORMATS)))
+    targets = _targets(params or {})
+    for name in names or []:
+        if name not in targets:
+            raise ValueError("Unknown target %r (expected one of %s)" % (name, ", ".join(targets)))
+    cache_dir = part_cache.path / "renders" if part_cache.enabled else out_dir / ".renders"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    jobs, files = {}, []
+    for name, (key, build) in targets.items():
+        if names and name not in names:
+            continue
+        data = None
+        for view in views:
+            for fmt in formats:
+                cached = cache_dir / ("%s-%s-%d-%s.%s" % (key, view, size, _RENDERER_HASH, fmt))
+                if not part_cache.enabled or not cached.exists():
+                    if data is None:
+                        data = to_brep(build())
+                    jobs[(name, view, fmt)] = (data, view, fmt, size, cached)
+                files.append((cached, out_dir / ("%s-%s.%s" % (name, view, fmt))))
+    if max_workers == 1:  # E.g. from the watch daemon, which already has everything imported
+        for (name, view, fmt), args in jobs.items():
+            print("Rendered %s-%s.%s in %.1fs" % (name, view, fmt, _render(*args)))
+    elif jobs:
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = {job: pool.submit(_render, *args) for job, args in jobs.items()}
+            for (name, view, fmt), future in futures.items():
+                print("Rendered %s-%s.%s in %.1fs" % (name, view, fmt, future.result()))
+    for cached, file in files:
+        shutil.copyfile(cached, file)
+    return [file for _, file in files]
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Renders PNG and SVG views of the parts and the assembly headlessly")
+    parser.add_argument("targets", nargs="*", help="assembly, headset_screw, stem or handle_bars (default: all)")
+    parser.add_argument("--views", default=",".join(VIEWS), help="Comma-separated list of: " + ", ".join(VIEWS))
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated list of: " + ", ".join(FORMATS))
+    parser.add_argument("--size", type=int, default=800, help="Size of the PNG images in pixels")
+    parser.add_argument("--out", default="renders", type=Path, help="Output directory")
+    parser.add_argument("--workers", type=int, default=None)
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        config = from_args(args)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+
+    files = render(args.targets, tuple(args.views.split(",")), tuple(args.formats.lower().split(",")), args.size,
+                   args.out, args.workers, config.params())
+    print("%d renders in %s" % (len(files), args.out))
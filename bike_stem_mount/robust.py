@@ -0,0 +1,232 @@
+# %%
+import copy
+import logging
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Iterable, Optional, Union
+from build123d import Compound, Edge, Shape, ShapeList
+from bike_stem_mount import kernel
+from bike_stem_mount.cache import from_brep, to_brep
+from bike_stem_mount.validate import GeometryError
+
+# ================== ROBUST OPERATIONS ==================
+# Booleans and fillets that OCCT may fail (or hang) on, run through a ladder of attempts until one gives a valid
+# result: as given, then with fuzzy tolerances, glued faces (fuse), cleaned inputs or the other parallel mode of the
+# booleans, and for fillets, slightly smaller radii. The attempt that succeeded is logged when it wasn't the first one.
+#
+# Each attempt runs with a timeout in a worker process, so that a hang or a crash in OCCT only costs that attempt. The
+# worker is spawned (a fresh process, which can use OCCT's thread pool unlike forked ones, see kernel.py), once per
+# process building and again after it was killed, and gets the inputs and kernel settings of each attempt, the shapes
+# as BREP. Without a timeout (e.g. while profiling or measuring the memory of the stages), attempts run in this
+# process.
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RobustSettings:
+    timeout: Optional[float] = float(os.environ.get("BIKE_STEM_MOUNT_OP_TIMEOUT", 120)) or None
+    """Seconds per attempt, run in the worker process (0 or None: in this process, without a timeout)"""
+    budget: Optional[float] = float(os.environ.get("BIKE_STEM_MOUNT_OP_BUDGET", 300)) or None
+    """Seconds for all the attempts of an operation"""
+    fuzzy_values: tuple[float, ...] = (1e-4, 1e-3, 1e-2)
+    """Fuzzy tolerances (mm) of the boolean attempts after the first"""
+    radius_factors: tuple[float, ...] = (0.995, 0.98, 0.95, 0.9)
+    """Fillet radius reductions of the attempts after the first ones"""
+
+
+settings = RobustSettings()
+
+Result = Union[Shape, ShapeList]
+Attempt = tuple[str, Callable[..., Result], dict[str, Any], dict[str, Any]]
+"""Name, function of this module (called with the input shapes and these keyword arguments) and kernel settings"""
+
+
+def _shapes(result: Result) -> list[Shape]:
+    return list(result) if isinstance(result, ShapeList) else [result]
+
+
+def _attempt(function: Callable[..., Result], shapes: list[Shape], kwargs: dict[str, Any],
+             kernel_settings: dict[str, Any]) -> Result:
+    with kernel.overridden(**kernel_settings):
+        return function(shapes, **kwargs)
+
+
+def _serve(connection: Connection):
+    """Worker process: runs the attempts received, and sends back their results as BREP"""
+    kernel.install()
+    connection.send("ready")
+    while True:
+        try:
+            function, data, kwargs, kernel_settings = connection.recv()
+        except EOFError:  # Closed by the building process
+            return
+        try:
+            result = _attempt(function, from_brep(data), kwargs, kernel_settings)
+            connection.send((None, isinstance(result, ShapeList), to_brep(_shapes(result))))
+        except Exception as ex:
+            connection.send(("%s: %s" % (type(ex).__name__, ex), None, None))
+
+
+class _Worker:
+    """Spawned process running the attempts of the process that started it"""
+
+    def __init__(self):
+        context = multiprocessing.get_context("spawn")
+        self.connection, connection = context.Pipe()
+        self.process = context.Process(target=_serve, args=(connection,), daemon=True)
+        self.process.start()
+        self.owner = os.getpid()
+        connection.close()
+        try:
+            self.connection.recv()  # Once imported, so that the timeouts don't count the start
+        except EOFError:
+            self.close()
+            raise RuntimeError("Worker failed to start (exit code %s)" % self.process.exitcode)
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+if globals().get("_worker") is not None and _worker.owner == os.getpid():  # Reloaded: the worker runs the old code
+    _worker.close()
+_worker: Optional[_Worker] = None
+"""Worker of this process, if started"""
+
+
+def _run(function: Callable[..., Result], shapes: list[Shape], kwargs: dict[str, Any],
+         kernel_settings: dict[str, Any], timeout: Optional[float]) -> Result:
+    """Runs the attempt in the worker process, killing it after the timeout, and loads its result (or without a
+    timeout, runs it in this process)"""
+    global _worker
+    if not timeout:  # On bare shapes as in the worker, as build123d moves the joints of its inputs to its results
+        return _attempt(function, [Compound.cast(shape.wrapped) for shape in shapes], kwargs, kernel_settings)
+    if _worker is None or _worker.owner != os.getpid():  # Not started yet, or by the parent of this forked process
+        _worker = _Worker()
+    worker = _worker
+    try:
+        worker.connection.send((function, to_brep(shapes), kwargs, kernel_settings))
+        if not worker.connection.poll(timeout):
+            raise TimeoutError("Timed out after %gs" % timeout)
+        error, is_list, data = worker.connection.recv()
+    except BaseException as ex:  # Timed out, crashed or interrupted: killed, and started again by the next attempt
+        _worker = None
+        worker.close()
+        if isinstance(ex, (EOFError, BrokenPipeError)):
+            raise RuntimeError("Worker crashed (exit code %s)" % worker.process.exitcode) from None
+        raise
+    if error is not None:
+        raise RuntimeError(error)
+    shapes = from_brep(data)
+    return ShapeList(shapes) if is_list else shapes[0]
+
+
+def _check(result: Result, solids: Optional[int]):
+    shapes = _shapes(result)
+    if not shapes or any(shape.wrapped is None or shape.wrapped.IsNull() or not shape.is_valid() for shape in shapes):
+        raise GeometryError("Invalid result")
+    found = sum(len(shape.solids()) for shape in shapes)
+    if solids is not None and found != solids:
+        raise GeometryError("Expected %d solids, got %d" % (solids, found))
+
+
+def _ladder(label: str, base: Shape, shapes: list[Shape], attempts: list[Attempt], solids: Optional[int]) -> Result:
+    """The result of the first attempt (on the input shapes) that succeeds, with the attributes (label, joints...) of
+    base"""
+    start, errors = time.perf_counter(), []
+    for name, function, kwargs, kernel_settings in attempts:
+        elapsed = time.perf_counter() - start
+        if settings.budget and elapsed > settings.budget:
+            errors.append("out of time budget (%gs)" % settings.budget)
+            break
+        timeout = settings.timeout
+        if timeout and settings.budget:
+            timeout = min(timeout, settings.budget - elapsed)
+        attempt_start = time.perf_counter()
+        try:
+            result = _run(function, shapes, kwargs, {**kernel.settings(), **kernel_settings}, timeout)
+            _check(result, solids)
+        except Exception as ex:
+            logger.info("%s: %s failed in %.2fs (%s)", label, name, time.perf_counter() - attempt_start, ex)
+            errors.append("%s: %s" % (name, ex))
+            continue
+        if errors:
+            logger.warning("%s: succeeded %s, after %s", label, name, "; ".join(errors))
+        logger.debug("%s: %s took %.2fs", label, name, time.perf_counter() - attempt_start)
+        if not isinstance(result, ShapeList):
+            base.copy_attributes_to(result, ["wrapped", "_NodeMixin__children", "joints"])
+            if getattr(base, "joints", None) and hasattr(result, "joints"):  # Copies, base may be a cached stage result
+                result.joints = {name: copy.copy(joint) for name, joint in base.joints.items()}
+                for joint in result.joints.values():
+                    joint.parent = result
+        return result
+    raise GeometryError("%s failed: %s" % (label, "; ".join(errors)))
+
+
+def _boolean(shapes: list[Shape], operation: str, fuzzy: float = 0, glue: bool = False, clean: bool = False) -> Result:
+    # Fuzzy value and glue default to the kernel settings
+    shape, *tools = [shape.clean() for shape in shapes] if clean else shapes
+    if operation == "fuse":
+        return shape.fuse(*tools, glue=glue, tol=fuzzy or None)
+    with kernel.overridden(**{"kernel_fuzzy_" + operation: fuzzy} if fuzzy else {}):
+        return shape.cut(*tools)
+
+
+def _boolean_attempts(operation: str, fuzzy: float) -> list[Attempt]:
+    attempts = [("as is" if not fuzzy else "with fuzzy=%g" % fuzzy, _boolean, {"operation": operation, "fuzzy": fuzzy},
+                 {})]
+    attempts += [("with fuzzy=%g" % value, _boolean, {"operation": operation, "fuzzy": value}, {})
+                 for value in settings.fuzzy_values if value > fuzzy]
+    if operation == "fuse":  # For touching faces
+        attempts.append(("glued", _boolean, {"operation": operation, "fuzzy": fuzzy, "glue": True}, {}))
+    attempts.append(("with clean inputs", _boolean, {"operation": operation, "fuzzy": fuzzy, "clean": True}, {}))
+    parallel = not kernel.settings()["kernel_parallel"]
+    attempts.append(("in %s mode" % ("parallel" if parallel else "serial"), _boolean,
+                     {"operation": operation, "fuzzy": fuzzy}, {"kernel_parallel": parallel}))
+    return attempts
+
+
+def fuse(shape: Shape, *tools: Shape, fuzzy: float = 0, solids: Optional[int] = None,
+         label: str = "fuse") -> Result:
+    """shape.fuse(*tools), trying larger fuzzy values, glue, cleaned inputs and the other parallel mode if it fails (or
+    the result doesn't have the given number of solids)"""
+    return _ladder(label, shape, [shape, *tools], _boolean_attempts("fuse", fuzzy), solids)
+
+
+def cut(shape: Shape, *tools: Shape, fuzzy: float = 0, solids: Optional[int] = None, label: str = "cut") -> Result:
+    """shape.cut(*tools), trying larger fuzzy values, cleaned inputs and the other parallel mode if it fails (or the
+    result doesn't have the given number of solids)"""
+    return _ladder(label, shape, [shape, *tools], _boolean_attempts("cut", fuzzy), solids)
+
+
+def _same_edges(shape: Shape, edges: list[Edge]) -> list[Edge]:
+    """The edges of shape closest to the given ones (e.g. after cleaning the shape they belonged to)"""
+    candidates = shape.edges()
+    return list({id(match): match for match in (
+        min(candidates, key=lambda other: (other.center() - edge.center()).length + abs(other.length - edge.length))
+        for edge in edges)}.values())
+
+
+def _fillet(shapes: list[Shape], radius: float, clean: bool = False) -> Shape:
+    shape, *edges = shapes
+    target = shape.clean() if clean else shape
+    candidates = target.edges()
+    if not all(edge in candidates for edge in edges):  # Cleaned, or loaded without the shared edges
+        edges = _same_edges(target, edges)
+    return target.fillet(radius, edges)
+
+
+def fillet(shape: Shape, radius: float, edges: Iterable[Edge], solids: Optional[int] = None,
+           label: str = "fillet") -> Shape:
+    """shape.fillet(radius, edges), trying a cleaned shape and slightly smaller radii if it fails"""
+    attempts = [("as is", _fillet, {"radius": radius}, {}),
+                ("with a clean shape", _fillet, {"radius": radius, "clean": True}, {})]
+    attempts += [("with radius %g" % (radius * factor), _fillet, {"radius": radius * factor}, {})
+                 for factor in settings.radius_factors]
+    return _ladder(label, shape, [shape, *edges], attempts, solids)
@@ -0,0 +1,94 @@
+# %%
+import argparse
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Optional
+from bike_stem_mount.cache import _build123d_version, _source_hash, from_brep, to_brep
+from bike_stem_mount.config import Config
+
+# ================== SNAPSHOT ==================
+# A prebuilt BREP of the assembly (by default, with the default parameters), so that exporting or viewing it doesn't
+# import the part scripts nor build (or load from the part cache and group into pieces) any part. Its key only depends
+# on the configuration, the sources of main.py and the part scripts and the build123d version, all of which are read
+# without importing build123d: a stale snapshot is ignored, and build123d is only imported to load a valid one.
+
+SNAPSHOT = Path(os.environ.get("BIKE_STEM_MOUNT_SNAPSHOT") or Path(__file__).with_name("snapshot.brep"))
+"""BREP file, next to a .json file with its key"""
+
+
+def snapshot_key(config: Config = Config()) -> str:
+    """Hash of everything the assembly depends on"""
+    data = [config.key(), _source_hash("bike_stem_mount.main"), _build123d_version()]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()[:32]
+
+
+def _info(path: Path) -> Path:
+    return path.with_suffix(".json")
+
+
+def is_current(config: Config = Config(), path: Path = SNAPSHOT) -> bool:
+    """Whether the snapshot exists and was built from the same configuration and sources"""
+    try:
+        return path.is_file() and json.loads(_info(path).read_text())["key"] == snapshot_key(config)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def load_snapshot(config: Config = Config(), path: Path = SNAPSHOT) -> Optional[Any]:
+    """The assembly of the snapshot (a compound with one child per printable piece), or None if it is missing or
+    stale"""
+    if not is_current(config, path):
+        return None
+    try:
+        return from_brep(path.read_bytes())[0]
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def write_snapshot(config: Config = Config(), path: Path = SNAPSHOT) -> Any:
+    """Builds the assembly and writes it as the snapshot, returning it"""
+    params = config.params()
+    from bike_stem_mount.main import build_assembly
+    assembly = build_assembly(**params)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for file, data in ((path, to_brep([assembly])),
+                       (_info(path), json.dumps({"key": snapshot_key(config), "config": config.to_dict(),
+                                                 "pieces": len(list(assembly))}, indent=2).encode())):
+        tmp = file.with_name("%s.tmp%d" % (file.name, os.getpid()))
+        tmp.write_bytes(data)
+        os.replace(tmp, file)  # Atomic, so that a stale .json never describes a new .brep
+    return assembly
+
+
+def assembly(config: Config = Config(), path: Path = SNAPSHOT) -> Any:
+    """The assembly from the snapshot if it is up to date, otherwise built (without updating the snapshot)"""
+    snapshot = load_snapshot(config, path)
+    if snapshot is not None:
+        return snapshot
+    params = config.params()
+    from bike_stem_mount.main import build_assembly
+    return build_assembly(**params)
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Builds the snapshot of the assembly, unless it is up to date")
+    parser.add_argument("--out", type=Path, default=SNAPSHOT, help="BREP file (its key is written next to it)")
+    parser.add_argument("--check", action="store_true", help="Only check whether the snapshot is up to date")
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        config = from_args(args)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+
+    if is_current(config, args.out):
+        print("Snapshot %s is up to date" % args.out)
+    elif args.check:
+        print("Snapshot %s is missing or stale" % args.out)
+        sys.exit(1)
+    else:
+        print("Wrote snapshot %s (%d pieces)" % (args.out, len(list(write_snapshot(config, args.out)))))
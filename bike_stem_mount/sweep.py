@@ -0,0 +1,148 @@
+# %%
+import argparse
+import csv
+import itertools
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Optional
+from build123d import export_step
+from bike_stem_mount.build_graph import assembly_nodes, run, seed
+from bike_stem_mount.cache import part_cache, scoped_build, to_brep
+from bike_stem_mount.config import PART_SECTIONS, Config, ConfigError, add_arguments, from_args, parse_overrides, \
+    parse_value
+from bike_stem_mount.export import QUALITY_PRESETS, export_mesh
+from bike_stem_mount.printability import analyze_pieces, combine
+from bike_stem_mount.main import build_assembly
+
+# ================== PARAMETER SWEEPS ==================
+# Builds many variants of the model, given as "<part>.<field>" overrides of the default parameters. All the parts of
+# all variants are built first by a single build graph, so parts shared by variants (e.g. the headset screw when only
+# the handle bars change) are built once, and then each variant is assembled and exported by a worker process.
+
+EXPORTERS = {"stl": lambda shape, path: export_mesh(shape, path, max_workers=1),
+             "3mf": lambda shape, path: export_mesh(shape, path, max_workers=1),
+             "step": export_step}
+PRINTABILITY_COLUMNS = ["overhang_area", "support_area", "thin_area", "min_wall"]
+
+
+def variant_params(overrides: dict[str, Any], base: Config = Config()) -> dict[str, Any]:
+    """The parameter dataclasses of a variant, failing before any modelling if a name or value is invalid"""
+    config = parse_overrides(overrides)
+    process_wide = sorted({section for section, _, _ in config.overrides} - set(PART_SECTIONS))
+    if process_wide:
+        raise ConfigError("The %s parameters can't vary between variants (set them with --config or --set)" %
+                          ", ".join(process_wide))
+    return base.merged(config).params()
+
+
+def grid_variants(specs: list[str]) -> list[dict[str, Any]]:
+    """The cartesian product of specs like "stem.angle=-9,-5,0" or "stem.range=(20,45),(25,50)\""""
+    axes = []
+    for spec in specs:
+        name, sep, values = spec.partition("=")
+        if not sep:
+            raise ValueError("Invalid grid spec %r (expected <part>.<field>=<value>,...)" % spec)
+        values = parse_value("[" + values + "]")
+        axes.append([(name.strip(), value) for value in (values if isinstance(values, list) else [values])])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def csv_variants(path: str) -> list[dict[str, Any]]:
+    """One variant per row, with a column per overridden parameter (empty cells keep the default)"""
+    with open(path, newline="") as f:
+        return [{name: parse_value(value) for name, value in row.items() if value and value.strip()}
+                for row in csv.DictReader(f)]
+
+
+def _export_variant(index: int, overrides: dict[str, Any], parts: dict[str, bytes], out_dir: Path,
+                    formats: tuple[str, ...], fuse: bool, printability: bool = False,
+                    base: Config = Config()) -> dict[str, Any]:
+    with scoped_build() as scope:  # Workers are reused: release the parts of each variant
+        seed(parts)
+        start = time.perf_counter()
+        assembly = build_assembly(**variant_params(overrides, base), workers=1, fuse=fuse)
+        files = []
+        for fmt in formats:
+            file = out_dir / ("variant-%03d.%s" % (index, fmt))
+            EXPORTERS[fmt](assembly, str(file))
+            files.append(file.name)
+        row = {"pieces": len(list(assembly)), "solids": len(assembly.solids()), "files": " ".join(files)}
+        if printability:
+            analyses = analyze_pieces(assembly, quality=QUALITY_PRESETS["draft"], max_workers=1)
+            summary = combine(analyses).summary()
+            row.update({column: summary[column] for column in PRINTABILITY_COLUMNS})
+        del assembly
+    return {**row, "seconds": round(time.perf_counter() - start, 3), "peak_mb": round(scope.peak / 2 ** 20, 1)}
+
+
+def sweep(variants: list[dict[str, Any]], out_dir: Path, formats: tuple[str, ...] = ("stl",),
+          max_workers: Optional[int] = None, fuse: bool = False, printability: bool = False,
+          base: Config = Config()) -> list[dict[str, Any]]:
+    """Builds and exports all variants (of the base configuration), writing a summary.csv report as they finish
+    (optionally with the totals of a draft printability analysis of each variant)"""
+    for fmt in formats:
+        if fmt not in EXPORTERS:
+            raise ValueError("Unknown format %r (expected one of %s)" % (fmt, ", ".join(EXPORTERS)))
+    params = [variant_params(overrides, base) for overrides in variants]  # Fail fast
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    nodes = [assembly_nodes(**variant) for variant in params]
+    failed = run([node for variant_nodes in nodes for node in variant_nodes], max_workers, raise_errors=False)
+    print("Built %d unique parts in %.1fs" % (len({node.key for variant_nodes in nodes for node in variant_nodes}),
+                                               time.perf_counter() - start))
+
+    columns = ["variant", "status", "seconds", "peak_mb", "pieces", "solids", "files", "error"] + \
+        (PRINTABILITY_COLUMNS if printability else []) + sorted({name for overrides in variants for name in overrides})
+    report = []
+    with open(out_dir / "summary.csv", "w", newline="") as f, ProcessPoolExecutor(max_workers) as pool:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        futures = {}
+        for index, (overrides, variant_nodes) in enumerate(zip(variants, nodes)):
+            row = {"variant": index, **overrides}
+            errors = [failed[node.key] for node in variant_nodes if node.key in failed]
+            if errors:
+                report.append({**row, "status": "failed", "error": "".join(
+                    traceback.format_exception_only(type(errors[-1]), errors[-1])).strip()})
+                writer.writerow(report[-1])
+                continue
+            parts = {node.key: to_brep(part_cache.recall(node.key)) for node in variant_nodes}
+            futures[pool.submit(_export_variant, index, overrides, parts, out_dir, formats, fuse, printability,
+                                 base)] = row
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                report.append({**row, "status": "ok", **future.result()})
+            except Exception as ex:
+                report.append({**row, "status": "failed", "error": "".join(
+                    traceback.format_exception_only(type(ex), ex)).strip()})
+            writer.writerow(report[-1])
+            f.flush()
+            print("Variant %(variant)d: %(status)s" % report[-1])
+    return sorted(report, key=lambda row: row["variant"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds and exports many variants of the bike stem mount")
+    parser.add_argument("grid", nargs="*", help="<part>.<field>=<value>,... (e.g. stem.angle=-9,-5 "
+                        "handle_bars.radius=16,18), building every combination")
+    parser.add_argument("--csv", help="File with one variant per row and one <part>.<field> column per parameter")
+    parser.add_argument("--out", default="sweep", type=Path, help="Output directory")
+    parser.add_argument("--formats", default="stl", help="Comma-separated list of: " + ", ".join(EXPORTERS))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--fuse", action="store_true", help="Fuse the solids of each printable piece (slower)")
+    parser.add_argument("--printability", action="store_true",
+                        help="Add overhang, support and wall thickness totals of each variant to the report")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    variants = (csv_variants(args.csv) if args.csv else []) + (grid_variants(args.grid) if args.grid else [])
+    if not variants:
+        parser.error("No variants given")
+    report = sweep(variants, args.out, tuple(args.formats.lower().split(",")), args.workers, args.fuse,
+                   args.printability, from_args(args))
+    print("%d/%d variants built, see %s" % (sum(row["status"] == "ok" for row in report), len(report),
+                                            args.out / "summary.csv"))
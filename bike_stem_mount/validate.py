@@ -0,0 +1,338 @@
+# %%
+import argparse
+import dataclasses
+import hashlib
+import json
+import math
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+from build123d import BoundBox, Compound, Face, Shape
+from OCP.BRepAdaptor import BRepAdaptor_Surface
+from OCP.BRepAlgoAPI import BRepAlgoAPI_Common
+from OCP.BRepBuilderAPI import BRepBuilderAPI_MakeVertex
+from OCP.BRepExtrema import BRepExtrema_DistShapeShape
+from OCP.BRepLProp import BRepLProp_SLProps
+from OCP.BRepTools import BRepTools
+from OCP.BRepTopAdaptor import BRepTopAdaptor_FClass2d
+from OCP.IntCurvesFace import IntCurvesFace_ShapeIntersector
+from OCP.TopAbs import TopAbs_IN, TopAbs_REVERSED
+from OCP.gp import gp_Dir, gp_Lin, gp_Pnt, gp_Pnt2d
+from bike_stem_mount import kernel
+from bike_stem_mount.cache import _canonical, part_cache, to_brep
+from bike_stem_mount.parts import global_params
+
+# ================== VALIDATION ==================
+# Checks of the built geometry, run on the finished parts and assembly instead of inline in the part scripts, so that
+# all the problems are reported at once. Cheap prefilters (bounding boxes of solids and faces) narrow down the exact
+# OCCT queries, and the results are cached by part key and check parameters, so unchanged parts aren't checked again.
+
+
+class GeometryError(Exception):
+    """A modelling step did not produce the geometry the rest of a part script relies on"""
+
+
+def expect(condition: bool, message: str):
+    """Like assert, but not removed by python -O and with a specific exception"""
+    if not condition:
+        raise GeometryError(message)
+
+
+@dataclass
+class ValidationParams:
+    min_wall: float = field(default_factory=lambda: global_params.wall_min)
+    """Minimum wall thickness, measured by casting rays into the solids from sample points of their faces"""
+    wall_samples: int = 3
+    """Samples per face (in each direction of its UV space)"""
+    edge_margin: float = field(default_factory=lambda: global_params.wall_min)
+    """Thin wall samples closer than this to an edge of their face are ignored: near edges where faces meet at sharp
+    angles (e.g. inclined cuts), rays hit the other face before min_wall without the wall being thin"""
+    max_overhang: float = 50
+    """Maximum angle from vertical of downward-facing inclined faces (horizontal ones are bridges or print beds)"""
+    min_clearance: float = field(default_factory=lambda: global_params.tol)
+    """Minimum distance between printable pieces"""
+    pieces: int = 4
+    """Expected number of printable pieces of the assembly"""
+
+
+p = ValidationParams()
+
+
+@dataclass
+class Issue:
+    target: str
+    check: str
+    message: str
+
+    def __str__(self) -> str:
+        return "%s: %s: %s" % (self.target, self.check, self.message)
+
+
+def _point(point) -> str:
+    return "(%.2f, %.2f, %.2f)" % tuple(point)
+
+
+def _face_samples(face: Face, n: int) -> list[tuple[gp_Pnt, gp_Dir]]:
+    """Points of a regular n x n grid of the UV space of the face that are inside it, with their outward normals"""
+    surface = BRepAdaptor_Surface(face.wrapped)
+    u_min, u_max, v_min, v_max = BRepTools.UVBounds_s(face.wrapped)
+    classifier = BRepTopAdaptor_FClass2d(face.wrapped, 1e-6)
+    samples = []
+    for i in range(n):
+        for j in range(n):
+            u, v = u_min + (i + 0.5) / n * (u_max - u_min), v_min + (j + 0.5) / n * (v_max - v_min)
+            if classifier.Perform(gp_Pnt2d(u, v)) != TopAbs_IN:
+                continue
+            props = BRepLProp_SLProps(surface, u, v, 1, 1e-6)
+            if not props.IsNormalDefined():
+                continue
+            normal = props.Normal()
+            if face.wrapped.Orientation() == TopAbs_REVERSED:
+                normal.Reverse()
+            samples.append((props.Value(), normal))
+    return samples
+
+
+# ================== PART CHECKS ==================
+
+
+def check_valid(shape: Shape, solids: int, params: ValidationParams) -> list[str]:
+    return ["Solid %d is not a valid BREP" % i for i, solid in enumerate(shape.solids()) if not solid.is_valid()]
+
+
+def check_solids(shape: Shape, solids: int, params: ValidationParams) -> list[str]:
+    found = len(shape.solids())
+    return [] if found == solids else ["Expected %d solids, got %d" % (solids, found)]
+
+
+def _edge_distance(face: Face, point: gp_Pnt) -> float:
+    """Distance from a point of the face to its boundary"""
+    vertex = BRepBuilderAPI_MakeVertex(point).Vertex()
+    return min(BRepExtrema_DistShapeShape(vertex, edge.wrapped).Value() for edge in face.edges())
+
+
+def check_wall(shape: Shape, solids: int, params: ValidationParams) -> list[str]:
+    """Thickness along the inward normal of sample points of each face (away from its edges)"""
+    thin = []
+    for solid in shape.solids():
+        intersector = IntCurvesFace_ShapeIntersector()
+        intersector.Load(solid.wrapped, 1e-6)
+        for face in solid.faces():
+            for point, normal in _face_samples(face, params.wall_samples):
+                intersector.Perform(gp_Lin(point, normal.Reversed()), 1e-3, params.min_wall)  # Skips the start
+                if intersector.NbPnt() > 0 and _edge_distance(face, point) >= params.edge_margin:
+                    thickness = min(intersector.WParameter(i + 1) for i in range(intersector.NbPnt()))
+                    thin.append((thickness, point.Coord()))
+    if not thin:
+        return []
+    thickness, point = min(thin)
+    return ["%d sampled walls are thinner than %.2f mm, down to %.2f mm at %s" % (
+        len(thin), params.min_wall, thickness, _point(point))]
+
+
+def check_overhang(shape: Shape, solids: int, params: ValidationParams) -> list[str]:
+    """Downward-facing inclined faces, assuming the model is printed as is (+Z up)"""
+    steep = []
+    for face in shape.faces():
+        for point, normal in _face_samples(face, params.wall_samples):
+            angle = math.degrees(math.asin(min(1.0, max(0.0, -normal.Z()))))
+            if params.max_overhang < angle < 89:
+                steep.append((angle, point.Coord()))
+    if not steep:
+        return []
+    angle, point = max(steep)
+    return ["%d sampled faces overhang more than %g degrees, up to %.0f degrees at %s" % (
+        len(steep), params.max_overhang, angle, _point(point))]
+
+
+@dataclass
+class PartChecks:
+    solids: int
+    """Expected number of solids"""
+    checks: tuple[str, ...] = ("valid", "solids", "cache", "wall")
+
+
+PART_CHECKS: dict[str, Callable[[Shape, int, ValidationParams], list[str]]] = {
+    "valid": check_valid,
+    "solids": check_solids,
+    "wall": check_wall,
+    "overhang": check_overhang,
+}
+
+
+def check_cache(shape: Shape, key: str) -> list[str]:
+    """Whether the part as built is the same BREP as when loaded from the part cache, so that a cold and a warm build
+    of its key give the parts built on it the same geometry (see PartCache.cached)"""
+    cached = part_cache.get(key)
+    if cached is None:  # Cache disabled
+        return []
+    return [] if to_brep([shape]) == to_brep(cached[:1]) else ["Differs from the part loaded from the part cache"]
+
+
+PARTS = {
+    "headset_screw": PartChecks(1),
+    "stem_screw_holes": PartChecks(1, ("valid", "solids", "cache", "wall", "overhang")),  # Has inbuilt supports
+    "stem": PartChecks(2),
+    "handle_bars": PartChecks(4),
+}
+
+# ================== ASSEMBLY CHECKS ==================
+
+
+def _face_boxes(piece: Shape) -> list[tuple[Face, BoundBox]]:
+    return [(face, face.bounding_box(optimal=False)) for face in piece.faces()]
+
+
+def boxes_overlap(a: BoundBox, b: BoundBox, margin: float = 0) -> bool:
+    return all(a.min.to_tuple()[i] - margin <= b.max.to_tuple()[i] and
+               b.min.to_tuple()[i] - margin <= a.max.to_tuple()[i] for i in range(3))
+
+
+def piece_distances(pieces: list[Shape], margin: float) -> dict[tuple[int, int], float]:
+    """Exact distance between the pairs of pieces closer than margin, comparing only the faces whose (loose) bounding
+    boxes are within margin"""
+    boxes = [piece.bounding_box(optimal=False) for piece in pieces]
+    faces = {}
+    distances = {}
+    for i in range(len(pieces)):
+        for j in range(i + 1, len(pieces)):
+            if not boxes_overlap(boxes[i], boxes[j], margin):
+                continue
+            for k in (i, j):
+                if k not in faces:
+                    faces[k] = _face_boxes(pieces[k])
+            distance = math.inf
+            for face_a, box_a in faces[i]:
+                if not boxes_overlap(box_a, boxes[j], margin):
+                    continue
+                for face_b, box_b in faces[j]:
+                    if boxes_overlap(box_a, box_b, margin):
+                        distance = min(distance, BRepExtrema_DistShapeShape(face_a.wrapped, face_b.wrapped).Value())
+            if distance < margin:
+                distances[(i, j)] = distance
+    return distances
+
+
+def check_pieces(pieces: list[Shape], distances: dict[tuple[int, int], float], params: ValidationParams) -> list[str]:
+    return [] if len(pieces) == params.pieces else [
+        "Expected %d printable pieces, got %d" % (params.pieces, len(pieces))]
+
+
+def check_clearance(pieces: list[Shape], distances: dict[tuple[int, int], float],
+                    params: ValidationParams) -> list[str]:
+    return ["Pieces %d and %d are %.3f mm apart (less than %.3f mm)" % (i, j, distance, params.min_clearance)
+            for (i, j), distance in sorted(distances.items())
+            if global_params.eps < distance < params.min_clearance]
+
+
+def check_interference(pieces: list[Shape], distances: dict[tuple[int, int], float],
+                       params: ValidationParams) -> list[str]:
+    """Volume shared by pieces (that are in contact)"""
+    issues = []
+    for (i, j), distance in sorted(distances.items()):
+        if distance <= global_params.eps:
+            volume = Compound(BRepAlgoAPI_Common(pieces[i].wrapped, pieces[j].wrapped).Shape()).volume
+            issues.append("Pieces %d and %d %s" % (
+                i, j, "intersect (%.3f mm3)" % volume if volume > global_params.eps else "touch"))
+    return issues
+
+
+ASSEMBLY_CHECKS: dict[str, Callable[[list[Shape], dict, ValidationParams], list[str]]] = {
+    "pieces": check_pieces,
+    "clearance": check_clearance,
+    "interference": check_interference,
+}
+
+# ================== RUNNING ==================
+
+_VALIDATOR_HASH = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:8]
+
+
+def _cached(key: str, config: dict, run: Callable[[], dict[str, list[str]]]) -> dict[str, list[str]]:
+    """The messages of each check for the part key and configuration, from the cache or by running the checks"""
+    config_hash = hashlib.sha256(json.dumps(_canonical(config), sort_keys=True).encode()).hexdigest()[:16]
+    file = part_cache.path / "checks" / ("%s-%s-%s.json" % (key, config_hash, _VALIDATOR_HASH))
+    if part_cache.enabled and file.exists():
+        return json.loads(file.read_text())
+    results = run()
+    if part_cache.enabled:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(results))
+        tmp.replace(file)
+    return results
+
+
+def validate_part(name: str, key: str, build: Callable[[], Shape], params: ValidationParams = p,
+                  checks: Optional[list[str]] = None) -> list[Issue]:
+    """Runs the checks of a part (see PARTS), building it only if they aren't cached"""
+    kernel.install()
+    spec = PARTS[name]
+    names = [check for check in spec.checks if checks is None or check in checks]
+
+    def run() -> dict[str, list[str]]:
+        shape = build()
+        return {check: check_cache(shape, key) if check == "cache" else PART_CHECKS[check](shape, spec.solids, params)
+                for check in names}
+    results = _cached(key, {"solids": spec.solids, "checks": names, "params": params}, run)
+    return [Issue(name, check, message) for check in names for message in results[check]]
+
+
+def validate(headset_p=None, stem_p=None, handle_bars_p=None, params: ValidationParams = p,
+             checks: Optional[list[str]] = None) -> list[Issue]:
+    """All issues of the parts and the assembly (default parameters if not given)"""
+    from bike_stem_mount.main import assembly_key, build_assembly, printable_pieces
+    from bike_stem_mount.parts.headset_screw import build_headset_screw, headset_screw_key, p as default_headset_p
+    from bike_stem_mount.parts.stem import build_stem, build_stem_screw_holes, stem_key, stem_screw_holes_key, \
+        p as default_stem_p
+    from bike_stem_mount.parts.handle_bars import build_handle_bars, handle_bars_key, p as default_handle_bars_p
+    headset_p, stem_p = headset_p or default_headset_p, stem_p or default_stem_p
+    handle_bars_p = handle_bars_p or default_handle_bars_p
+
+    parts = {
+        "headset_screw": (headset_screw_key(headset_p), lambda: build_headset_screw(headset_p)),
+        "stem_screw_holes": (stem_screw_holes_key(stem_p), lambda: build_stem_screw_holes(stem_p)[0]),
+        "stem": (stem_key(stem_p, headset_p), lambda: build_stem(stem_p, headset_p)[0]),
+        "handle_bars": (handle_bars_key(handle_bars_p, stem_p, headset_p),
+                        lambda: build_handle_bars(handle_bars_p, stem_p, headset_p)),
+    }
+    issues = []
+    for name, (key, build) in parts.items():
+        issues += validate_part(name, key, build, params, checks)
+
+    names = [check for check in ASSEMBLY_CHECKS if checks is None or check in checks]
+
+    def run() -> dict[str, list[str]]:
+        pieces = list(build_assembly(headset_p, stem_p, handle_bars_p))
+        distances = piece_distances(pieces, params.min_clearance) if set(names) - {"pieces"} else {}
+        return {check: ASSEMBLY_CHECKS[check](pieces, distances, params) for check in names}
+    results = _cached(assembly_key(headset_p, stem_p, handle_bars_p), {"checks": names, "params": params}, run)
+    return issues + [Issue("assembly", check, message) for check in names for message in results[check]]
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Checks the parts and the assembly, reporting all issues at once")
+    parser.add_argument("--checks", nargs="*", choices=list(PART_CHECKS) + ["cache"] + list(ASSEMBLY_CHECKS),
+                        help="Checks to run (default: those of each part, and all assembly checks)")
+    for param in dataclasses.fields(ValidationParams):
+        parser.add_argument("--" + param.name.replace("_", "-"), type=type(getattr(p, param.name)),
+                            help="Default: %s" % getattr(p, param.name))
+    parser.add_argument("--json", type=Path, help="Also write the issues to this JSON file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        parts = from_args(args).params()  # Before the defaults derived from the global parameters
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+    params = ValidationParams(**{param.name: getattr(args, param.name) for param in dataclasses.fields(p)
+                                 if getattr(args, param.name) is not None})
+    issues = validate(**parts, params=params, checks=args.checks)
+    for issue in issues:
+        print(issue)
+    if args.json:
+        args.json.write_text(json.dumps([dataclasses.asdict(issue) for issue in issues], indent=2))
+    print("%d issues" % len(issues))
+    sys.exit(1 if issues else 0)
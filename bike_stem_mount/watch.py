@@ -0,0 +1,157 @@
+# %%
+import argparse
+import importlib
+import sys
+import time
+import traceback
+from pathlib import Path
+from typing import Optional
+from bike_stem_mount.cache import module_imports, module_path, part_cache
+
+# ================== WATCH MODE ==================
+# A long-running process that keeps build123d imported and the built parts (and their modelling stages) in memory.
+# When a script of the package changes, it and every module that (indirectly) imports it are reloaded in dependency
+# order, and the assembly is rebuilt: parts whose key did not change are reused from memory, and the rest only rerun
+# the stages whose code or parameters changed. The parameter files given with --config are watched too, and they and
+# the --set overrides are applied to each build.
+
+_PACKAGE = "bike_stem_mount"
+_NEVER_RELOAD = {_PACKAGE + ".cache", _PACKAGE + ".watch"}  # Hold the in-memory caches and this loop
+
+
+def _loaded_modules() -> set[str]:
+    return {name for name, module in list(sys.modules.items())
+            if name.startswith(_PACKAGE + ".") and getattr(module, "__file__", None) and name not in _NEVER_RELOAD}
+
+
+def affected_modules(changed: set[str]) -> list[str]:
+    """The changed modules and the loaded modules that (indirectly) import them, in dependency order"""
+    loaded = _loaded_modules()
+    imports = {name: module_imports(name) & loaded for name in loaded}
+    affected = changed & loaded
+    while True:
+        more = {name for name in loaded - affected if imports[name] & affected}
+        if not more:
+            break
+        affected |= more
+    ordered = []
+    while len(ordered) < len(affected):
+        ready = sorted(name for name in affected - set(ordered) if imports[name] & affected <= set(ordered))
+        if not ready:  # Reloading in any order would leave some modules with the objects of the old ones
+            raise ImportError("Cannot reload %s: module-level import cycle" %
+                              ", ".join(sorted(affected - set(ordered))))
+        ordered += ready
+    return ordered
+
+
+def _sources(config_files: list[Path] = ()) -> dict[Path, float]:
+    """Modification time of the source of each loaded module of this package, and of the parameter files"""
+    times = {}
+    for path in [module_path(name) for name in _loaded_modules() | _NEVER_RELOAD] + list(config_files):
+        try:
+            times[path] = path.stat().st_mtime
+        except OSError:
+            pass
+    return times
+
+
+def _module_name(path: Path) -> str:
+    relative = path.relative_to(module_path(_PACKAGE).parent.parent).with_suffix("")
+    return ".".join(relative.parts[:-1] if relative.name == "__init__" else relative.parts)
+
+
+class Watcher:
+    """Rebuilds the assembly and pushes it to the outputs whenever the package's sources change"""
+
+    def __init__(self, exports: list[Path] = (), render_views: tuple[str, ...] = (), show: bool = False,
+                 config_args: Optional[argparse.Namespace] = None):
+        self.exports = list(exports)
+        self.render_views = render_views
+        self.show = show
+        self.config_args = config_args  # --config and --set arguments (see config.add_arguments), read for each build
+        self.config_files = list(config_args.config) if config_args else []
+        self.assembly = None
+        self.params = {}
+
+    def build(self):
+        main = importlib.import_module(_PACKAGE + ".main")
+        config = importlib.import_module(_PACKAGE + ".config")
+        start = time.perf_counter()
+        # After reloading the part scripts, so that the parameters are instances of their current dataclasses
+        self.params = (config.from_args(self.config_args) if self.config_args else config.Config()).params()
+        keys = {node.key for node in main.assembly_nodes(**self.params)}
+        built = sorted(key.rsplit("-", 1)[0] for key in keys if not part_cache.contains(key))
+        self.assembly = main.build_assembly(**self.params, workers=1)
+        part_cache.retain(keys)  # Older versions of the parts are not needed anymore
+        print("Built %s in %.2fs" % (", ".join(built) or "nothing new", time.perf_counter() - start), flush=True)
+        self.push()
+
+    def push(self):
+        for path in self.exports:
+            start = time.perf_counter()
+            if path.suffix.lower() in (".step", ".stp"):
+                from build123d import export_step
+                export_step(self.assembly, str(path))
+            else:
+                from bike_stem_mount.export import export_mesh
+                export_mesh(self.assembly, path, quality="draft", max_workers=1)
+            print("Exported %s in %.2fs" % (path, time.perf_counter() - start), flush=True)
+        if self.render_views:
+            from bike_stem_mount.render import render
+            render(views=self.render_views, formats=("png",), max_workers=1, params=self.params)
+        if self.show:
+            try:
+                import ocp_vscode
+                ocp_vscode.show(self.assembly, names=["bike-stem-mount"])
+            except ImportError:  # Optional
+                print("Install ocp_vscode to show the assembly", flush=True)
+
+    def reload(self, changed: set[str]):
+        modules = affected_modules(changed)
+        print("Reloading %s" % ", ".join(name.rsplit(".", 1)[-1] for name in modules), flush=True)
+        for name in modules:
+            importlib.reload(sys.modules[name])
+        part_cache.invalidate_sources()
+
+    def run(self, interval: float = 0.5):
+        self.build()
+        sources = _sources(self.config_files)
+        print("Watching %d source files (Ctrl+C to stop)" % len(sources), flush=True)
+        while True:
+            time.sleep(interval)
+            current = _sources(self.config_files)
+            changed = {path for path, mtime in current.items() if sources.get(path) != mtime}
+            if not changed:
+                continue
+            sources = current
+            try:
+                modules = {_module_name(path) for path in changed if path not in self.config_files}
+                if modules:  # Otherwise only the parameter files changed
+                    self.reload(modules)
+                self.build()
+            except Exception:  # Keep watching, e.g. until a syntax error is fixed
+                traceback.print_exc()
+            sources = _sources(self.config_files)  # Including modules imported for the first time
+
+
+if __name__ == "__main__":
+    from bike_stem_mount.config import ConfigError, add_arguments, from_args
+    parser = argparse.ArgumentParser(description="Keeps the parts built in memory, rebuilding them when the part "
+                                                 "scripts (or their parameters) change")
+    parser.add_argument("--export", nargs="*", type=Path, default=[],
+                        help="Files (.stl, .3mf or .step) to export the assembly to after each build")
+    parser.add_argument("--render", nargs="?", const="iso", default="",
+                        help="Render PNG views (comma-separated, default: iso) into renders/ after each build")
+    parser.add_argument("--show", action="store_true", help="Show the assembly in the OCP CAD Viewer after each build")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between checks for changes")
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        from_args(args)  # Invalid parameters are reported before building (and after each change of the files)
+    except ConfigError as ex:
+        parser.exit(2, "%s\n" % ex)
+
+    try:
+        Watcher(args.export, tuple(filter(None, args.render.split(","))), args.show, args).run(args.interval)
+    except KeyboardInterrupt:
+        pass
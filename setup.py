@@ -1,3 +1,4 @@
 from setuptools import setup, find_packages
 
-setup(name='bike_stem_mount', version='0.0.1', packages=find_packages())
+setup(name='bike_stem_mount', version='0.0.1', packages=find_packages(),
+      package_data={'bike_stem_mount': ['snapshot.brep', 'snapshot.json']})  # If prebuilt, see snapshot.py